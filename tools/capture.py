@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# Append-only log of the traffic going through comm_router
+# Each record has the monotonic time the data was read, the id of the
+# endpoint it came from and the id of the endpoint it was routed to (none
+# for the record of the read itself). Ids are written out once per file
+# as name records and referred to by index after that.
+#
+# Layout: an 8 byte header followed by records
+#   header: magic, version
+#   record: timestamp (f64), length (u32), source (u16), destination (u16), data
+# A name record has source NAME, destination is the index it defines and
+# data is the id. A crash can leave a partial record at the end, readers
+# stop before it and writers truncate it away.
+#
+# Records are written to disk by a thread of the writer's own, so a slow
+# disk never holds up whoever is capturing. If more than max_pending bytes
+# are waiting for it, new records are dropped (and counted) until it has
+# caught up.
+
+import collections
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'CRCP'
+VERSION = 1
+
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<dIHH')
+
+NAME = 0xFFFF
+NONE = 0xFFFE
+MAX_NAMES = NONE
+
+# buffered records are handed to the writer thread once there is this
+# much of them
+flush_size = 65536
+# most data waiting for the writer thread
+max_pending = 4 << 20
+
+
+class Writer(object):
+
+    def __init__(self, path):
+        self.path = path
+        end = 0
+        if os.path.exists(path):
+            reader = Reader(path)
+            for record in reader:
+                pass
+            end = reader.end
+            reader.close()
+
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, end)
+        os.lseek(self.fd, end, os.SEEK_SET)
+        self.buffer = bytearray()
+        if end == 0:
+            self.buffer += HEADER.pack(MAGIC, VERSION)
+        self.names = {}
+        # records that didn't fit in max_pending
+        self.dropped = 0
+
+        # chunks for the writer thread and their total size
+        self.pending = collections.deque()
+        self.pending_size = 0
+        self.closing = False
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='capture')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def index(self, name):
+        index = self.names.get(name)
+        if index is None:
+            index = len(self.names)
+            if index >= MAX_NAMES:
+                raise ValueError("too many endpoint ids in one capture")
+            self.names[name] = index
+            encoded = name.encode('utf-8')
+            self.buffer += RECORD.pack(0, len(encoded), NAME, index)
+            self.buffer += encoded
+        return index
+
+
+    def write(self, timestamp, source, destination, data):
+        if self.pending_size + len(self.buffer) + RECORD.size + len(data) > max_pending:
+            self.dropped += 1
+            return
+        source = self.index(source)
+        if destination is None:
+            destination = NONE
+        else:
+            destination = self.index(destination)
+        buffer = self.buffer
+        buffer += RECORD.pack(timestamp, len(data), source, destination)
+        buffer += data
+        if len(buffer) >= flush_size:
+            self.flush()
+
+
+    def flush(self):
+        # hand what is buffered to the writer thread
+        if not self.buffer:
+            return
+        with self.changed:
+            self.pending.append(self.buffer)
+            self.pending_size += len(self.buffer)
+            self.changed.notify()
+        self.buffer = bytearray()
+
+
+    def close(self):
+        # waits for everything to be written
+        self.flush()
+        with self.changed:
+            self.closing = True
+            self.changed.notify()
+        self.thread.join()
+        os.close(self.fd)
+
+
+    def _run(self):
+        while True:
+            with self.changed:
+                while not self.pending and not self.closing:
+                    self.changed.wait()
+                if not self.pending:
+                    return
+                chunk = self.pending.popleft()
+            written = 0
+            try:
+                while written < len(chunk):
+                    written += os.write(self.fd, chunk[written:])
+            except OSError as e:
+                print("Error writing capture %s: %s" % (self.path, e))
+            with self.changed:
+                self.pending_size -= len(chunk)
+
+
+class Reader(object):
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            # a new capture may not have anything in it yet
+            self.map = mmap.mmap(fd, 0, prot=mmap.PROT_READ) if size else None
+        finally:
+            os.close(fd)
+
+        self.end = 0
+        if self.map is None:
+            return
+        if size < HEADER.size or HEADER.unpack_from(self.map, 0) != (MAGIC, VERSION):
+            self.map.close()
+            raise ValueError("%s is not a comm_router capture" % path)
+        self.end = HEADER.size
+
+
+    def __iter__(self):
+        """
+        Yields (timestamp, source id, destination id or None, data) for
+        each complete record, end is the offset after the last one
+        """
+        if self.map is None:
+            return
+        data = self.map
+        size = len(data)
+        names = {}
+        offset = HEADER.size
+        while offset + RECORD.size <= size:
+            timestamp, length, source, destination = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            if start + length > size:
+                break
+            offset = start + length
+            self.end = offset
+
+            if source == NAME:
+                names[destination] = data[start:offset].decode('utf-8')
+                continue
+            yield (timestamp, names.get(source),
+                   None if destination == NONE else names.get(destination),
+                   data[start:offset])
+
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
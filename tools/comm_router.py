@@ -1,7 +1,8 @@
 #!/usr/bin/python
 
+import argparse
+import copy
 import socket
-import time
 import json
 import endpoint
 import os
@@ -9,77 +10,202 @@ import os
 debug = False
 home = os.environ['HOME']
 
+parser = argparse.ArgumentParser(description="routes data between serial ports and sockets")
+parser.add_argument('--config', action="store", type=str, default=home+'/routing.conf', help="routing configuration file")
+parser.add_argument('--port', action="store", type=int, default=18990, help="udp port to listen for requests on")
+args = parser.parse_args()
+
 # load configuration from file
 try:
     print 'loading configuration from file...'
-    endpoint.load(home+'/routing.conf')
+    endpoint.load(args.config)
     print 'configuration successfully loaded'
 except Exception as e:
     print 'error loading configuration'
     print e
 
+# pick up edits to the configuration file while running
+try:
+    endpoint.auto_reload(args.config)
+except Exception as e:
+    print 'not watching configuration file for changes'
+    print e
+
 # we will listen here for requests
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 sock.setblocking(False)
-sock.bind(('0.0.0.0', 18990))
+sock.bind(('0.0.0.0', args.port))
+
+# requests can be as big as a udp datagram
+max_request_size = 65536
+# most requests answered in one wakeup, so endpoints get a turn too
+max_request_batch = 64
+
+# version 2 replies can carry only the endpoints that changed since a
+# revision the client has seen: every change to the configuration bumps
+# the revision, and each endpoint (or removed id) records the revision it
+# last changed in
+revision = 0
+snapshot = {}
+changed_in = {}
+removed_in = {}
+
+
+def update_revision():
+    global revision
+    # copied, to_json() hands out the endpoints' own connection lists
+    current = dict((_endpoint.id, copy.deepcopy(_endpoint.to_json())) for _endpoint in endpoint.get_endpoints())
+    changed = [id for id in current if snapshot.get(id) != current[id]]
+    removed = [id for id in snapshot if id not in current]
+    if not changed and not removed:
+        return
+    revision += 1
+    for id in changed:
+        changed_in[id] = revision
+        removed_in.pop(id, None)
+    for id in removed:
+        removed_in[id] = revision
+        del changed_in[id]
+    snapshot.clear()
+    snapshot.update(current)
+
+
+def perform(msg):
+    # carry out one request, returns True if it may have changed the
+    # configuration
+    request = msg['request']
+    print("Got request %s") % request
+
+    if request == 'add endpoint':
+        endpoint.add(endpoint.from_json(msg))
+
+    elif request == 'remove endpoint':
+        endpoint.remove(msg['id'])
+
+    elif request == 'connect endpoints':
+        endpoint.connect(msg['source'], msg['target'])
+
+    elif request == 'disconnect endpoints':
+        endpoint.disconnect(msg['source'], msg['target'])
+
+    # traffic counters don't change the configuration, nor does asking
+    # for it
+    elif request in ('stats', 'get endpoints'):
+        return False
+
+    elif request == 'save all':
+        endpoint.save_async(msg['filename'])
+        return False
+
+    # Hard load replaces current configuration with load configuration,
+    # endpoints that are the same in both are left running
+    # Soft load appends load configuration to current configuration
+    elif request == 'load all':
+        if msg['soft'] == False:
+            print("Hard load")
+            endpoint.reload(msg['filename'])
+        else:
+            endpoint.load(msg['filename'])
 
-while True:
-    # don't hog the cpu
-    time.sleep(0.01)
+    # Apply routing.conf (or filename) without interrupting unchanged routes
+    elif request == 'reload':
+        endpoint.reload(msg.get('filename', args.config))
 
-    # read all endpoints and write all routes
-    for _endpoint in endpoint.endpoints:
-        _endpoint.read()
+    # replace the whole configuration in one go, like a hard load
+    elif request == 'apply':
+        endpoint.apply({"endpoints": msg['endpoints']})
 
-    try:
-        # see if there is a new request
-        data, address = sock.recvfrom(1024)
-        print("\n%s sent %s\n") % (address, data)
+    else:
+        raise ValueError("unknown request: %s" % request)
 
-        # all requests come packed in json
-        msg = json.loads(data)
+    return True
 
-        try:
-            request = msg['request']
-            print("Got request %s") % request
-        except:
-            print "No request!"
-            continue
 
-        if request == 'add endpoint':
-            endpoint.add(endpoint.from_json(msg))
+def handle_v1(msg, address):
+    if 'request' not in msg:
+        print "No request!"
+        return
 
-        elif request == 'remove endpoint':
-            endpoint.remove(msg['id'])
-            sock.sendto(endpoint.to_json(), address)
+    changed = perform(msg)
+    if msg['request'] == 'stats':
+        sock.sendto(endpoint.stats_json(msg.get('id')), address)
+        return
 
-        elif request == 'connect endpoints':
-            print('got connect request: %s') % data
-            endpoint.connect(msg['source'], msg['target'])
+    # send updated list of endpoints
+    sock.sendto(endpoint.to_json(), address)
 
-        elif request == 'disconnect endpoints':
-            endpoint.disconnect(msg['source'], msg['target'])
+    # save current list of endpoints, in the background
+    if changed:
+        endpoint.save_async(args.config)
 
-        elif request == 'save all':
-            endpoint.save(msg['filename'])
 
-        # Hard load replaces current configuration with load configuration
-        # Soft load appends load configuration to current configuration
-        elif request == 'load all':
-            if msg['soft'] == False:
-                print("Hard load")
-                # TODO: garbage collect?
-                endpoint.endpoints = []
-            endpoint.load(msg['filename'])
+def handle_v2(msg, address):
+    # {"version": 2, "id": anything, "ops": [request, ...], "since": revision}
+    # every op is carried out in order, the reply has a result for each,
+    # and the endpoints changed since 'since' (all of them without it)
+    results = []
+    changed = False
+    for op in msg.get('ops', []):
+        try:
+            changed = perform(op) or changed
+            result = {"ok": True}
+            if op['request'] == 'stats':
+                result["stats"] = json.loads(endpoint.stats_json(op.get('id')))['stats']
+        except Exception as e:
+            print("Error: %s") % e
+            result = {"ok": False, "error": str(e)}
+        results.append(result)
+
+    update_revision()
+    reply = {"version": 2,
+             "id": msg.get('id'),
+             "results": results,
+             "revision": revision}
+    since = msg.get('since')
+    if since is None:
+        reply["endpoints"] = [snapshot[id] for id in sorted(snapshot)]
+    else:
+        reply["changed"] = [snapshot[id] for id in sorted(snapshot) if changed_in[id] > since]
+        reply["removed"] = sorted(id for id in removed_in if removed_in[id] > since)
 
-        # send updated list of endpoints
-        sock.sendto(endpoint.to_json(), address)
+    try:
+        sock.sendto(json.dumps(reply), address)
+    except socket.error as e:
+        # too big for a datagram, the client should ask with 'since'
+        del reply["results"]
+        reply.pop("endpoints", None)
+        reply.pop("changed", None)
+        reply["error"] = str(e)
+        sock.sendto(json.dumps(reply), address)
 
-        # save current list of endpoints
-        endpoint.save(home+'/routing.conf')
+    if changed:
+        endpoint.save_async(args.config)
 
-    except socket.error as e:
-        continue
-    except Exception as e:
-        print("Error: %s") % e
-        continue
+
+def handle_request(events):
+    for i in range(max_request_batch):
+        try:
+            data, address = sock.recvfrom(max_request_size)
+        except socket.error as e:
+            return
+        print("\n%s sent %s\n") % (address, data)
+
+        try:
+            # all requests come packed in json
+            msg = json.loads(data)
+            if msg.get('version') == 2:
+                handle_v2(msg, address)
+            else:
+                handle_v1(msg, address)
+        except socket.error as e:
+            continue
+        except Exception as e:
+            print("Error: %s") % e
+            continue
+
+
+# requests are serviced by the same event loop as the endpoints
+endpoint.watch(sock.fileno(), handle_request)
+
+# sleep until an endpoint or the request socket has data, then forward it
+endpoint.run()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# Benchmark for the comm_router forwarding path
+# A router is started in a child process, packets are sent into a udp
+# endpoint and timed when they come out of the second endpoint, which is
+# a udp socket, a multicast group on the loopback interface, a unix socket
+# or a shared memory ring (--transport).
+
+import argparse
+import os
+import resource
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import time
+
+import endpoint
+import shmring
+
+parser = argparse.ArgumentParser(description="comm_router forwarding latency benchmark")
+parser.add_argument('--packets', action="store", type=int, default=2000, help="number of packets to send")
+parser.add_argument('--rate', action="store", type=float, default=50, help="packets per second")
+parser.add_argument('--size', action="store", type=int, default=64, help="packet size in bytes")
+parser.add_argument('--port', action="store", type=int, default=18100, help="first of two local udp ports to use")
+parser.add_argument('--mode', action="append", choices=['sleep', 'epoll'], help="router loop to measure (default: both)")
+parser.add_argument('--transport', action="append", choices=['udp', 'multicast', 'unix', 'shm'], help="output endpoint type to measure (default: udp)")
+parser.add_argument('--group', action="store", default='239.255.77.1', help="multicast group to use")
+args = parser.parse_args()
+
+directory = tempfile.mkdtemp(prefix='comm_router_bench')
+router_path = os.path.join(directory, 'router')
+ring_path = os.path.join(directory, 'ring')
+receiver_path = os.path.join(directory, 'receiver')
+
+
+def sleep_loop():
+    # the original comm_router loop: poll every endpoint every 10 ms
+    while True:
+        time.sleep(0.01)
+        endpoint.wakeup_time = endpoint.monotonic()
+        for _endpoint in endpoint.endpoints:
+            _endpoint.read()
+        endpoint.flush_pending()
+
+
+def start_router(mode, transport):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    endpoint.add(endpoint.UDPEndpoint('0.0.0.0', args.port, 'in', ['out']))
+    if transport == 'udp':
+        endpoint.add(endpoint.UDPEndpoint('127.0.0.1', args.port + 1, 'out', []))
+    elif transport == 'multicast':
+        out = endpoint.MulticastEndpoint(args.group, args.port + 1, 'out', [])
+        out.configure({'interface': '127.0.0.1'})
+        endpoint.add(out)
+    else:
+        out = endpoint.UnixEndpoint(router_path, 'out', [])
+        if transport == 'shm':
+            out.configure({'shm': ring_path})
+        endpoint.add(out)
+
+    try:
+        if mode == 'sleep':
+            sleep_loop()
+        else:
+            endpoint.run()
+    finally:
+        os._exit(0)
+
+
+class Receiver(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.ring = None
+        if transport == 'udp':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind(('127.0.0.1', args.port + 1))
+        elif transport == 'multicast':
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((args.group, args.port + 1))
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                   socket.inet_aton(args.group) + socket.inet_aton('127.0.0.1'))
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(receiver_path)
+
+
+    def subscribe(self):
+        # the router learns about unix peers when they send to it
+        if self.transport in ('udp', 'multicast'):
+            return
+        self.socket.sendto(b'', router_path)
+        if self.transport == 'shm':
+            self.ring = shmring.Reader(ring_path)
+
+
+    def receive(self):
+        data = self.socket.recv(65535)
+        if self.ring is None:
+            return [data]
+        return self.ring.read()
+
+
+    def close(self):
+        self.socket.close()
+        if self.ring is not None:
+            self.ring.close()
+        if self.transport in ('unix', 'shm'):
+            os.unlink(receiver_path)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(mode, transport):
+    rx = Receiver(transport)
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    pid = start_router(mode, transport)
+    time.sleep(0.5)
+    rx.subscribe()
+    time.sleep(0.1)
+
+    padding = b'\0' * max(0, args.size - 12)
+    period = 1.0 / args.rate
+    latencies = []
+
+    def receive_until(deadline):
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            rx.socket.settimeout(remaining)
+            try:
+                packets = rx.receive()
+            except socket.timeout:
+                return
+            now = time.time()
+            for data in packets:
+                latencies.append(now - struct.unpack_from('<Id', data)[1])
+
+    start_cpu = cpu_time(resource.getrusage(resource.RUSAGE_SELF))
+    try:
+        for sequence in range(args.packets):
+            tx.sendto(struct.pack('<Id', sequence, time.time()) + padding, ('127.0.0.1', args.port))
+            receive_until(time.time() + period)
+        # collect stragglers
+        receive_until(time.time() + 0.1)
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        router_usage = os.wait4(pid, 0)[2]
+        rx.close()
+        tx.close()
+    own_cpu = cpu_time(resource.getrusage(resource.RUSAGE_SELF)) - start_cpu
+
+    latencies.sort()
+    name = "%s/%s" % (mode, transport)
+    if not latencies:
+        print("%-12s no packets received" % name)
+        return
+
+    print("%-12s received %d/%d  latency ms: p50 %.3f  p90 %.3f  p99 %.3f  max %.3f  "
+          "cpu us/packet: router %.1f  sender+receiver %.1f" % (
+        name, len(latencies), args.packets,
+        percentile(latencies, 50) * 1e3,
+        percentile(latencies, 90) * 1e3,
+        percentile(latencies, 99) * 1e3,
+        latencies[-1] * 1e3,
+        cpu_time(router_usage) * 1e6 / args.packets,
+        own_cpu * 1e6 / args.packets))
+
+
+try:
+    for transport in args.transport or ['udp']:
+        for mode in args.mode or ['sleep', 'epoll']:
+            measure(mode, transport)
+finally:
+    shutil.rmtree(directory)
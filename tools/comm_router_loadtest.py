@@ -0,0 +1,322 @@
+#!/usr/bin/python
+
+# Throughput and latency benchmark for comm_router
+# comm_router.py is started with a generated routing.conf, one endpoint
+# for the traffic to come in on and one for it to go out of. Serial ports
+# are stood in for by pseudo-terminals. Synthetic MAVLink is sent at each
+# rate and size asked for, and whatever comes out is timed.
+#
+# Results are printed as a table and, with --json, written as JSON so
+# they can be compared between releases.
+
+import argparse
+import fcntl
+import json
+import os
+import platform
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tty
+
+import mavframe
+
+scenarios = ('udp-udp', 'serial-udp', 'udp-serial', 'serial-serial')
+
+parser = argparse.ArgumentParser(description="comm_router throughput and latency benchmark")
+parser.add_argument('--scenario', action="append", choices=scenarios, help="source-sink endpoint types to measure (default: all)")
+parser.add_argument('--rate', action="append", type=float, help="packets per second to send (default: 100, 1000 and 5000)")
+parser.add_argument('--size', action="append", type=int, help="MAVLink payload size, 12 to 255 bytes (default: 32 and 255)")
+parser.add_argument('--duration', action="store", type=float, default=5.0, help="seconds to send for at each rate and size")
+parser.add_argument('--framing', action="store", choices=['mavlink', 'none'], default='mavlink', help="framing of the router's endpoints")
+parser.add_argument('--threaded', action="store_true", help="give the serial endpoints their own i/o threads")
+parser.add_argument('--coalesce', action="store", type=float, default=0, metavar="WINDOW", help="coalesce_window for udp sinks, in seconds")
+parser.add_argument('--port', action="store", type=int, default=18200, help="first of the local udp ports to use")
+parser.add_argument('--json', action="store", type=str, help="write the results to this file, - for stdout")
+args = parser.parse_args()
+
+router_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'comm_router.py')
+
+# payload: sequence number and send time, padded to the size asked for
+PAYLOAD = struct.Struct('<Id')
+# not in any dialect, so the router can't mistake it for a real message
+MSGID = 0xFFFFFF
+
+
+def mavlink_frame(seq, payload):
+    header = struct.pack('<BBBBBBBHB', mavframe.STX_V2, len(payload), 0, 0, seq & 0xFF,
+                         255, 190, MSGID & 0xFFFF, MSGID >> 16)
+    frame = bytearray(header + payload)
+    crc = mavframe.x25crc(frame, 1, len(frame))
+    return bytes(frame + struct.pack('<H', crc))
+
+
+def cpu_time(pid):
+    # user + system time of pid in seconds
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Pty(object):
+    # the router opens the slave side like a serial port, we use the master
+
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        self.path = os.ttyname(self.slave)
+        # keep data moving byte for byte
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
+        fcntl.fcntl(self.master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.endpoint = {"type": "serial", "port": self.path, "baudrate": 115200}
+
+
+    def fileno(self):
+        return self.master
+
+
+    def send(self, data):
+        written = 0
+        while written < len(data):
+            try:
+                written += os.write(self.master, data[written:])
+            except OSError:
+                # full, the router isn't keeping up
+                return written > 0
+        return True
+
+
+    def receive(self):
+        return os.read(self.master, 65536)
+
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class UDPSource(object):
+
+    def __init__(self, port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.address = ('127.0.0.1', port)
+        self.endpoint = {"type": "udp", "ip": "0.0.0.0", "port": port}
+
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            return False
+        return True
+
+
+    def close(self):
+        self.socket.close()
+
+
+class UDPSink(object):
+
+    def __init__(self, port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.socket.bind(('127.0.0.1', port))
+        self.endpoint = {"type": "udp", "ip": "127.0.0.1", "port": port}
+
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+    def receive(self):
+        return self.socket.recv(65536)
+
+
+    def close(self):
+        self.socket.close()
+
+
+def make(kind, port):
+    if kind == 'udp-source':
+        return UDPSource(port)
+    if kind == 'udp-sink':
+        return UDPSink(port)
+    return Pty()
+
+
+def write_config(directory, source, sink):
+    source.endpoint.update({"id": "source", "connections": ["sink"]})
+    sink.endpoint.update({"id": "sink", "connections": []})
+    for settings in (source.endpoint, sink.endpoint):
+        if args.framing == 'mavlink':
+            settings["framing"] = "mavlink"
+        # big enough that drops are the router falling behind, not a burst
+        settings["queue_size"] = 1 << 20
+        if args.threaded and settings["type"] == "serial":
+            settings["threaded"] = True
+    if args.coalesce and sink.endpoint["type"] == "udp":
+        sink.endpoint["coalesce_window"] = args.coalesce
+    path = os.path.join(directory, 'routing.conf')
+    with open(path, 'w') as f:
+        json.dump({"endpoints": [source.endpoint, sink.endpoint]}, f, indent=4)
+    return path
+
+
+def start_router(directory, config):
+    log = open(os.path.join(directory, 'router.log'), 'w')
+    try:
+        router = subprocess.Popen([sys.executable, router_script, '--config', config, '--port', str(args.port + 2)],
+                                  stdout=log, stderr=subprocess.STDOUT, cwd=directory,
+                                  env=dict(os.environ, HOME=directory))
+    finally:
+        log.close()
+    # let it open its endpoints
+    time.sleep(1.0)
+    if router.poll() is not None:
+        raise RuntimeError("comm_router exited, see %s" % os.path.join(directory, 'router.log'))
+    return router
+
+
+def measure(router, source, sink, rate, size):
+    padding = b'\0' * (size - PAYLOAD.size)
+    parser = mavframe.FrameParser()
+    latencies = []
+    sent = 0
+    refused = 0
+    # time of the last read, and the number of reads (datagrams for a udp sink)
+    last = [0]
+    reads = [0]
+
+    def receive():
+        try:
+            data = sink.receive()
+        except (OSError, socket.error):
+            return
+        now = time.time()
+        last[0] = now
+        reads[0] += 1
+        for frame in parser.parse(data):
+            latencies.append(now - PAYLOAD.unpack_from(frame.data, mavframe.HEADER_LEN_V2)[1])
+
+    start_cpu = cpu_time(router.pid)
+    start = time.time()
+    end = start + args.duration
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        # send everything due by now, in one go at high rates
+        due = min(int((now - start) * rate) + 1, int(args.duration * rate))
+        while sent < due:
+            if not source.send(mavlink_frame(sent, PAYLOAD.pack(sent, time.time()) + padding)):
+                refused += 1
+            sent += 1
+        timeout = max(0, min(start + sent / rate, end) - time.time())
+        while select.select([sink], [], [], timeout)[0]:
+            receive()
+            timeout = 0
+
+    # collect stragglers
+    deadline = time.time() + 0.5
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0 or not select.select([sink], [], [], remaining)[0]:
+            break
+        receive()
+    # the sending time, or longer if the router was still catching up
+    elapsed = max(args.duration, last[0] - start)
+    router_cpu = cpu_time(router.pid) - start_cpu
+
+    latencies.sort()
+    received = len(latencies)
+    result = {"rate": rate,
+              "size": size,
+              "sent": sent,
+              "received": received,
+              "refused": refused,
+              "sink_reads": reads[0],
+              "drop_rate": 1.0 - float(received) / sent if sent else 0.0,
+              "throughput_pps": received / elapsed,
+              "throughput_bytes_per_second": received * (size + 12) / elapsed,
+              "router_cpu_percent": 100.0 * router_cpu / elapsed,
+              "router_cpu_us_per_packet": 1e6 * router_cpu / received if received else None}
+    if latencies:
+        result["latency_ms"] = {"p50": percentile(latencies, 50) * 1e3,
+                                "p99": percentile(latencies, 99) * 1e3,
+                                "max": latencies[-1] * 1e3}
+    return result
+
+
+def run_scenario(scenario):
+    source_kind, sink_kind = scenario.split('-')
+    directory = tempfile.mkdtemp(prefix='comm_router_loadtest')
+    source = make(source_kind + '-source', args.port)
+    sink = make(sink_kind + '-sink', args.port + 1)
+    router = None
+    results = []
+    try:
+        router = start_router(directory, write_config(directory, source, sink))
+        for size in args.size or [32, 255]:
+            for rate in args.rate or [100, 1000, 5000]:
+                result = measure(router, source, sink, rate, size)
+                result["scenario"] = scenario
+                results.append(result)
+                report(result)
+    finally:
+        if router is not None:
+            router.send_signal(signal.SIGTERM)
+            router.wait()
+        source.close()
+        sink.close()
+        shutil.rmtree(directory)
+    return results
+
+
+def report(result):
+    latency = result.get("latency_ms")
+    print("%-14s %7.0f/s %4d B  received %7d/%-7d drops %5.1f%%  %8.0f pkt/s  "
+          "latency ms p50 %s p99 %s  router cpu %5.1f%% %s us/pkt" % (
+        result["scenario"], result["rate"], result["size"], result["received"], result["sent"],
+        result["drop_rate"] * 100, result["throughput_pps"],
+        "%.3f" % latency["p50"] if latency else "-",
+        "%.3f" % latency["p99"] if latency else "-",
+        result["router_cpu_percent"],
+        "%.1f" % result["router_cpu_us_per_packet"] if result["router_cpu_us_per_packet"] else "-"))
+    sys.stdout.flush()
+
+
+for size in args.size or []:
+    if not PAYLOAD.size <= size <= 255:
+        parser.error("--size must be between %d and 255" % PAYLOAD.size)
+
+results = []
+for scenario in args.scenario or scenarios:
+    results.extend(run_scenario(scenario))
+
+if args.json:
+    output = json.dumps({"version": 1,
+                         "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         "machine": platform.machine(),
+                         "node": platform.node(),
+                         "python": platform.python_version(),
+                         "framing": args.framing,
+                         "threaded": args.threaded,
+                         "coalesce_window": args.coalesce,
+                         "duration": args.duration,
+                         "results": results}, indent=4, sort_keys=True)
+    if args.json == '-':
+        print(output)
+    else:
+        with open(args.json, 'w') as f:
+            f.write(output + '\n')
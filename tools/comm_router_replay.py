@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+# Feed a comm_router capture back into a router
+# What each endpoint read is sent again, with its original timing or
+# faster, to the router endpoint with the same id in --config (udp servers
+# and unix sockets) or to wherever --target says.
+
+import argparse
+import json
+import os
+import socket
+import tempfile
+import time
+
+import capture
+
+parser = argparse.ArgumentParser(description="replay a comm_router capture")
+parser.add_argument('capture', help="capture file to replay")
+parser.add_argument('--config', action="store", type=str, default=os.path.expanduser('~') + '/routing.conf', help="routing configuration to find the router's endpoints in")
+parser.add_argument('--target', action="append", default=[], metavar="ID=ADDRESS", help="send what endpoint ID read to ADDRESS, host:port for udp or a unix socket path")
+parser.add_argument('--source', action="append", metavar="ID", help="only replay what these endpoints read (default: all)")
+parser.add_argument('--speed', action="store", type=float, default=1.0, help="playback speed, 0 to go as fast as possible")
+parser.add_argument('--list', action="store_true", help="print the records instead of sending them")
+args = parser.parse_args()
+
+
+def parse_address(address):
+    if address.startswith('/'):
+        return address
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+def router_addresses():
+    targets = {}
+    try:
+        with open(args.config) as f:
+            configuration = json.load(f)
+    except (IOError, ValueError) as e:
+        print("not using %s: %s" % (args.config, e))
+        return targets
+
+    for endpoint in configuration['endpoints']:
+        if endpoint['type'] == 'udp' and endpoint['ip'] == '0.0.0.0':
+            targets[endpoint['id']] = ('127.0.0.1', int(endpoint['port']))
+        elif endpoint['type'] == 'unix':
+            targets[endpoint['id']] = endpoint['path']
+    return targets
+
+
+def list_records(reader):
+    start = None
+    for timestamp, source, destination, data in reader:
+        if start is None:
+            start = timestamp
+        print("%10.6f %s -> %s %d bytes" % (timestamp - start, source, destination or '(read)', len(data)))
+
+
+def replay(reader):
+    targets = router_addresses()
+    for target in args.target:
+        id, address = target.split('=', 1)
+        targets[id] = parse_address(address)
+
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # unix endpoints only answer sockets with an address
+    directory = tempfile.mkdtemp(prefix='comm_router_replay')
+    unix_path = os.path.join(directory, 'replay')
+    unix = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    unix.bind(unix_path)
+
+    sent = 0
+    skipped = set()
+    start = None
+    first = None
+    try:
+        for timestamp, source, destination, data in reader:
+            # only what was read, the rest is what the router did with it
+            if destination is not None:
+                continue
+            if args.source and source not in args.source:
+                continue
+            address = targets.get(source)
+            if address is None:
+                if source not in skipped:
+                    print("no address for %s, skipping its traffic" % source)
+                    skipped.add(source)
+                continue
+
+            if first is None:
+                first = timestamp
+                start = time.time()
+            if args.speed > 0:
+                delay = start + (timestamp - first) / args.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if isinstance(address, tuple):
+                udp.sendto(data, address)
+            else:
+                unix.sendto(data, address)
+            sent += 1
+    finally:
+        udp.close()
+        unix.close()
+        os.unlink(unix_path)
+        os.rmdir(directory)
+
+    if start is not None:
+        print("replayed %d packets in %.3f s" % (sent, time.time() - start))
+
+
+reader = capture.Reader(args.capture)
+try:
+    if args.list:
+        list_records(reader)
+    else:
+        replay(reader)
+finally:
+    reader.close()
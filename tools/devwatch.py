@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+# Waits for device nodes to come back
+# An unplugged serial port loses its node (/dev/ttyUSB0), and with the last
+# usb serial device udev removes /dev/serial/by-id too. The node's directory
+# is watched with inotify; while that directory is missing its nearest
+# parent that exists is watched instead, moving back down as directories
+# are created, so callbacks run as soon as the node is there again.
+
+import errno
+import os
+
+import fswatch
+
+# how long to wait before trying a device again when no event comes,
+# doubling each time up to the maximum
+retry_interval = 1.0
+max_retry_interval = 16.0
+
+# on the node's own directory: created, renamed into place, or its
+# permissions fixed by udev
+NODE_EVENTS = fswatch.IN_CREATE | fswatch.IN_MOVED_TO | fswatch.IN_ATTRIB
+# on a parent standing in for a directory that is missing
+DIRECTORY_EVENTS = fswatch.IN_CREATE | fswatch.IN_MOVED_TO
+
+
+class DeviceWatcher(object):
+
+    def __init__(self):
+        self.watcher = fswatch.Watcher()
+        # path: [callback], and the directory each path is watched through
+        self.callbacks = {}
+        self.watched = {}
+        # directory: (wd, mask), and wd: directory
+        self.watches = {}
+        self.directories = {}
+
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+
+    def wait(self, path, callback):
+        """
+        Call callback(mask) whenever the node at path is created or
+        changed, until cancel(). Waiting again for the same thing is fine.
+        Raises EnvironmentError if nothing on the way to path can be watched.
+        """
+        path = os.path.abspath(path)
+        callbacks = self.callbacks.setdefault(path, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+        if path in self.watched:
+            return
+        try:
+            self._arm(path)
+        except EnvironmentError:
+            self.cancel(path, callback)
+            raise
+
+
+    def cancel(self, path, callback):
+        path = os.path.abspath(path)
+        callbacks = self.callbacks.get(path, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if callbacks:
+            return
+        self.callbacks.pop(path, None)
+        directory = self.watched.pop(path, None)
+        if directory is not None and directory not in self.watched.values():
+            self._remove(directory)
+
+
+    def handle_events(self):
+        for wd, mask, name in self.watcher.read():
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+
+            if mask & fswatch.IN_IGNORED:
+                # the directory is gone, fall back to its parent
+                del self.directories[wd]
+                self.watches.pop(directory, None)
+                for path in [path for path, watched in self.watched.items() if watched == directory]:
+                    self._rearm(path)
+                continue
+
+            created = os.path.join(directory, name)
+            for path, watched in list(self.watched.items()):
+                if watched != directory:
+                    continue
+                if created == path:
+                    self._notify(path, mask)
+                elif path.startswith(created + os.sep):
+                    # a directory on the way to the node is back
+                    self._rearm(path)
+                    if os.path.exists(path):
+                        self._notify(path, mask)
+
+
+    def close(self):
+        self.watcher.close()
+
+
+    def _notify(self, path, mask):
+        for callback in list(self.callbacks.get(path, ())):
+            callback(mask)
+
+
+    def _arm(self, path):
+        # watch the closest directory on the way to path that exists
+        old = self.watched.pop(path, None)
+        try:
+            directory = os.path.dirname(path)
+            mask = NODE_EVENTS
+            while True:
+                try:
+                    self._add(directory, mask)
+                    break
+                except EnvironmentError as e:
+                    parent = os.path.dirname(directory)
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR) or parent == directory:
+                        raise
+                    directory, mask = parent, DIRECTORY_EVENTS
+            self.watched[path] = directory
+        finally:
+            if old is not None and old not in self.watched.values():
+                self._remove(old)
+
+        if directory != os.path.dirname(path):
+            # the next directory down may have been made before the watch
+            # was in place, when it was its event is never coming
+            child = path[:path.index(os.sep, len(directory) + 1)]
+            if os.path.isdir(child):
+                self._arm(path)
+
+
+    def _rearm(self, path):
+        try:
+            self._arm(path)
+        except EnvironmentError:
+            # nothing to watch, the caller's retries will have to do
+            self.watched.pop(path, None)
+
+
+    def _add(self, directory, mask):
+        wd, current = self.watches.get(directory, (None, 0))
+        if wd is None or current | mask != current:
+            wd = self.watcher.add(directory, current | mask)
+            self.watches[directory] = (wd, current | mask)
+            self.directories[wd] = directory
+
+
+    def _remove(self, directory):
+        wd, mask = self.watches.pop(directory, (None, 0))
+        if wd is None:
+            return
+        self.directories.pop(wd, None)
+        try:
+            self.watcher.remove(wd)
+        except EnvironmentError:
+            # already gone with its directory
+            pass
@@ -1,13 +1,446 @@
 #!/usr/bin/python
 
+import os
 import serial
 import socket
+import stat
+import struct
+import array
 import json
+import select
+import errno
+import fcntl
+import heapq
+import itertools
+import math
+import time
+import collections
+import tempfile
+import threading
+
+import capture
+import devwatch
+import fswatch
+import mavframe
+import shmring
 
 debug = False
 
 endpoints = []
 
+# the same endpoints by id
+registry = {}
+
+# how long to wait before trying to open a serial port again, doubling
+# each time up to the maximum (the device node appearing cuts it short)
+reopen_interval = devwatch.retry_interval
+max_reopen_interval = devwatch.max_retry_interval
+
+# chunks that may wait between a 'threaded' serial port's threads and the
+# event loop, in each direction
+thread_queue_length = 64
+
+# largest possible udp datagram
+max_datagram_size = 65535
+
+# most bytes taken from a serial port in one read
+serial_read_size = 65536
+
+# most datagrams taken from one socket per wakeup, so that a flooded
+# endpoint can't starve the others (epoll will report it again)
+max_read_batch = 256
+
+# requested kernel receive buffer for udp sockets, so bursts queue up in
+# the kernel instead of being dropped (capped by net.core.rmem_max)
+udp_receive_buffer = 1 << 20
+
+# default bound on each endpoint's outbound queue, in bytes
+default_queue_size = 16384
+
+# what to do with data written to an endpoint whose queue is full
+#   drop-oldest: discard queued data to make room
+#   drop-newest: discard the new data
+#   block: keep it, and stop reading the endpoint it came from until the
+#     queue drains
+queue_policies = ('drop-oldest', 'drop-newest', 'block')
+
+# MAVLink messages that skip ahead of everything else queued for an
+# endpoint: HEARTBEAT, MANUAL_CONTROL and RC_CHANNELS_OVERRIDE
+default_priority_messages = frozenset((0, 69, 70))
+
+# udp server endpoints forget peers they haven't heard from in this long
+default_peer_timeout = 30.0
+
+# datagram endpoints with a coalesce_window pack queued packets into
+# datagrams of up to this many bytes, holding them at most this long
+default_coalesce_size = 1400
+default_coalesce_max_delay = 0.01
+
+# endpoints with 'dedup' set drop frames they have already seen within
+# this many seconds (MAVLink sequence numbers wrap in a few seconds)
+default_dedup_window = 0.2
+
+# a changed routing.conf is reloaded this long after the last write to it
+reload_delay = 0.2
+
+# most bytes taken from a tcp stream in one recv
+tcp_read_size = 65536
+
+# tcp client endpoints retry a failed connection after this long,
+# doubling each time up to the maximum
+reconnect_interval = 0.5
+max_reconnect_interval = 16.0
+
+# buffered capture records are written out at least this often
+capture_flush_interval = 1.0
+
+# forwarding latency histogram, bucket i counts latencies under 2**i us
+latency_buckets = 24
+
+
+try:
+	monotonic = time.monotonic
+except AttributeError:
+	# python 2 has no monotonic clock, ask libc for it
+	import ctypes
+	import ctypes.util
+
+	class _timespec(ctypes.Structure):
+		_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+	_librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+	_clock_gettime = _librt.clock_gettime
+	_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+	_CLOCK_MONOTONIC = 1
+
+	def monotonic():
+		t = _timespec()
+		if _clock_gettime(_CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+		return t.tv_sec + t.tv_nsec * 1e-9
+
+
+# event loop
+# file descriptors are registered here together with the handler that
+# services them, run_once() sleeps in epoll until one of them is ready
+# or the next timer is due
+poller = select.epoll()
+handlers = {}
+timers = []
+_timer_sequence = itertools.count()
+
+# endpoints with queued writes, flushed once the current wakeup is handled
+pending = []
+
+# when the current wakeup started, data read during it is stamped with this
+wakeup_time = 0
+
+
+class Timer(object):
+
+	def __init__(self, deadline, callback):
+		self.deadline = deadline
+		self.callback = callback
+
+
+	def cancel(self):
+		self.callback = None
+
+
+def watch(fd, handler, events=select.EPOLLIN):
+	handlers[fd] = handler
+	poller.register(fd, events)
+
+
+def modify(fd, events):
+	poller.modify(fd, events)
+
+
+def unwatch(fd):
+	if handlers.pop(fd, None) is None:
+		return
+	try:
+		poller.unregister(fd)
+	except (IOError, OSError, ValueError):
+		pass
+
+
+def call_later(delay, callback):
+	timer = Timer(monotonic() + delay, callback)
+	heapq.heappush(timers, (timer.deadline, next(_timer_sequence), timer))
+	return timer
+
+
+def run_once(timeout=1.0):
+	global wakeup_time
+	now = monotonic()
+	while timers and timers[0][0] <= now:
+		timer = heapq.heappop(timers)[2]
+		if timer.callback is not None:
+			callback = timer.callback
+			timer.callback = None
+			callback()
+
+	if timers:
+		# epoll counts in whole ms and python 2 rounds down, which would
+		# spin until a timer less than 1 ms away is due
+		timeout = min(timeout, math.ceil(max(0, timers[0][0] - monotonic()) * 1000) / 1000.0)
+
+	try:
+		events = poller.poll(timeout)
+	except (IOError, OSError) as e:
+		if e.errno == errno.EINTR:
+			return
+		raise
+
+	wakeup_time = monotonic()
+	for fd, mask in events:
+		handler = handlers.get(fd)
+		# a previous handler may have closed this fd
+		if handler is not None:
+			handler(mask)
+
+	flush_pending()
+
+
+def flush_pending():
+	while pending:
+		endpoint = pending.pop()
+		if endpoint.pending:
+			endpoint.flush()
+
+
+def run():
+	while True:
+		run_once()
+
+
+# open capture logs, {path: [capture.Writer, number of endpoints using it]}
+captures = {}
+_capture_timer = None
+
+
+def open_capture(path):
+	global _capture_timer
+	if path not in captures:
+		captures[path] = [capture.Writer(path), 0]
+		if _capture_timer is None:
+			_capture_timer = call_later(capture_flush_interval, _flush_captures)
+	captures[path][1] += 1
+	return captures[path][0]
+
+
+def close_capture(path):
+	entry = captures[path]
+	entry[1] -= 1
+	if entry[1] == 0:
+		entry[0].close()
+		del captures[path]
+
+
+def _flush_captures():
+	global _capture_timer
+	_capture_timer = None
+	if not captures:
+		return
+	for writer, users in captures.values():
+		writer.flush()
+	_capture_timer = call_later(capture_flush_interval, _flush_captures)
+
+
+# inotify watcher shared by everything that wants to hear about files
+_file_watcher = None
+_file_watch_masks = {}
+_file_watch_directories = {}
+_file_callbacks = {}
+
+
+def on_file_change(path, callback, mask=fswatch.IN_CLOSE_WRITE | fswatch.IN_MOVED_TO):
+	# call callback(mask) when path (which doesn't have to exist) changes
+	# the directory is watched, so replacing the file is seen too
+	global _file_watcher
+	if _file_watcher is None:
+		_file_watcher = fswatch.Watcher()
+		watch(_file_watcher.fileno(), _handle_file_events)
+
+	directory, name = os.path.split(os.path.abspath(path))
+	_file_watch_masks[directory] = _file_watch_masks.get(directory, 0) | mask
+	wd = _file_watcher.add(directory, _file_watch_masks[directory])
+	_file_watch_directories[wd] = directory
+	_file_callbacks.setdefault((wd, name), []).append(callback)
+	return wd
+
+
+def _handle_file_events(events):
+	for wd, mask, name in _file_watcher.read():
+		if mask & fswatch.IN_IGNORED:
+			directory = _file_watch_directories.pop(wd, None)
+			_file_watch_masks.pop(directory, None)
+			for key in [key for key in _file_callbacks if key[0] == wd]:
+				del _file_callbacks[key]
+			continue
+		for callback in list(_file_callbacks.get((wd, name), ())):
+			callback(mask)
+
+
+# device nodes the serial endpoints are waiting for
+_device_watcher = None
+
+
+def wait_for_device_node(path, callback):
+	# call callback(mask) when the node at path comes (back), even if the
+	# directory it is in has to be created first
+	global _device_watcher
+	if _device_watcher is None:
+		_device_watcher = devwatch.DeviceWatcher()
+		watch(_device_watcher.fileno(), _handle_device_events)
+	_device_watcher.wait(path, callback)
+
+
+def cancel_device_node(path, callback):
+	if _device_watcher is not None:
+		_device_watcher.cancel(path, callback)
+
+
+def _handle_device_events(events):
+	_device_watcher.handle_events()
+
+
+class Stats(object):
+
+	def __init__(self):
+		self.packets_in = 0
+		self.bytes_in = 0
+		self.packets_out = 0
+		self.bytes_out = 0
+		self.drops = 0
+		self.errors = 0
+		self.latency = [0] * latency_buckets
+
+
+	def add_latency(self, seconds):
+		bucket = int(seconds * 1e6).bit_length()
+		if bucket >= latency_buckets:
+			bucket = latency_buckets - 1
+		self.latency[bucket] += 1
+
+
+	def latency_percentile(self, p):
+		# upper bound of the bucket holding the p-th percentile, in us
+		total = sum(self.latency)
+		if total == 0:
+			return None
+		rank = total * p / 100.0
+		count = 0
+		for bucket, n in enumerate(self.latency):
+			count += n
+			if count >= rank:
+				return 1 << bucket
+		return 1 << (latency_buckets - 1)
+
+
+	def to_json(self):
+		return {"packets_in": self.packets_in,
+				"bytes_in": self.bytes_in,
+				"packets_out": self.packets_out,
+				"bytes_out": self.bytes_out,
+				"drops": self.drops,
+				"errors": self.errors,
+				# counts[i] is the number of packets forwarded in under 2**i us
+				"latency_us": {"counts": self.latency,
+						"p50": self.latency_percentile(50),
+						"p99": self.latency_percentile(99)}}
+
+
+class RouteFilter(object):
+	# rules for what one endpoint passes to one of its connections
+	#   allow: only these MAVLink messages (ids or names)
+	#   deny: never these messages
+	#   rates: {message: max Hz}
+	#   bytes_per_second, burst: token bucket for everything on the route
+	# message rules need the source to be framing MAVLink
+
+	def __init__(self, settings):
+		self.settings = settings
+		self.allow = None
+		if 'allow' in settings:
+			self.allow = set(mavframe.message_id(message) for message in settings['allow'])
+		self.deny = set(mavframe.message_id(message) for message in settings.get('deny', ()))
+		self.intervals = {}
+		for message, rate in settings.get('rates', {}).items():
+			self.intervals[mavframe.message_id(message)] = 1.0 / float(rate)
+		self.next_time = {}
+
+		self.rate = float(settings.get('bytes_per_second', 0))
+		self.burst = float(settings.get('burst', self.rate))
+		self.tokens = self.burst
+		self.last_time = 0
+
+		self.filtered = 0
+
+
+	def accept(self, msgid, size, now):
+		interval = None
+		if msgid is not None:
+			if (self.allow is not None and msgid not in self.allow) or msgid in self.deny:
+				self.filtered += 1
+				return False
+			interval = self.intervals.get(msgid)
+			if interval is not None and now < self.next_time.get(msgid, 0):
+				self.filtered += 1
+				return False
+
+		if self.rate:
+			self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+			self.last_time = now
+			if self.tokens < size:
+				self.filtered += 1
+				return False
+			self.tokens -= size
+
+		if interval is not None:
+			# keep to the average rate when the stream is jittery
+			next_time = self.next_time.get(msgid, 0) + interval
+			if next_time <= now:
+				next_time = now + interval
+			self.next_time[msgid] = next_time
+		return True
+
+
+def set_dscp(sock, dscp):
+	# mark outgoing packets with a DSCP class (e.g. 46, expedited forwarding)
+	if dscp is not None:
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, dscp << 2)
+
+
+class DedupCache(object):
+	# keys seen in the last window seconds
+
+	def __init__(self, window):
+		self.window = window
+		self.times = {}
+		self.order = collections.deque()
+		self.duplicates = 0
+
+
+	def seen(self, key, now):
+		times = self.times
+		order = self.order
+		expired = now - self.window
+		while order and order[0][0] <= expired:
+			timestamp, old_key = order.popleft()
+			if times.get(old_key) == timestamp:
+				del times[old_key]
+
+		if key in times:
+			self.duplicates += 1
+			return True
+		times[key] = now
+		order.append((now, key))
+		return False
+
+
 class Endpoint(object):
 
 	def __init__(self, id, type, connectionIds):
@@ -16,8 +449,399 @@ class Endpoint(object):
 		self.id = id
 		self.type = type
 		self.connectionIds = connectionIds
-		# target destinations for inbound traffic
-		self.connections = []
+		# target destinations for inbound traffic, a tuple rebuilt by
+		# update_routes() whenever the endpoints change
+		self.connections = ()
+		# the same, paired with the RouteFilter for each (or None)
+		self.routes = ()
+		self.filters = {}
+
+		# optional settings, see configure()
+		self.framing = None
+		self.parser = None
+
+		# (sysid, compid) pairs heard on this endpoint when framing
+		self.systems = set()
+		self.system_ids = set()
+
+		# file descriptor registered with the event loop, None when closed
+		self.fd = None
+		self.events = 0
+
+		# outbound data waiting for the fd to become writable, priority
+		# traffic has its own queue that is always written first
+		self.queue = collections.deque()
+		self.urgent_queue = collections.deque()
+		# the unwritten end of a partly written packet, it goes before
+		# anything else so streams don't get interleaved packets
+		self.remainder = None
+		self.queued_bytes = 0
+		self.queue_size = default_queue_size
+		self.queue_policy = 'drop-oldest'
+		self.pending = False
+		self.waiting = False
+
+		# 'block' policy: endpoints that stopped reading because of us
+		self.paused = False
+		self.blocked_sources = []
+
+		# what goes into urgent_queue, see configure()
+		self.priority_messages = default_priority_messages
+		self.priority_sources = frozenset()
+		self.dscp = None
+
+		# drops inbound frames seen recently, see configure()
+		self.dedup = None
+		self.dedup_key = None
+
+		# capture.Writer logging this endpoint's traffic, see set_capture()
+		self.capture_setting = None
+		self.capture_path = None
+		self.capture = None
+
+		self.stats = Stats()
+
+
+	def configure(self, settings):
+		# 'framing': 'mavlink' splits inbound data into whole MAVLink frames
+		# and routes frames with a target only to endpoints that lead to it
+		self.framing = settings.get('framing')
+		if self.framing == 'mavlink':
+			self.parser = mavframe.FrameParser()
+		elif self.framing is None:
+			self.parser = None
+		else:
+			raise ValueError("unknown framing: %s" % self.framing)
+
+		# 'queue_size' bytes may wait to be written, then 'queue_policy' applies
+		self.queue_size = int(settings.get('queue_size', default_queue_size))
+		self.queue_policy = settings.get('queue_policy', 'drop-oldest')
+		if self.queue_policy not in queue_policies:
+			raise ValueError("unknown queue policy: %s" % self.queue_policy)
+
+		# 'priority_messages' (ids or names) and everything from the
+		# endpoints in 'priority_sources' go ahead of other queued data
+		if 'priority_messages' in settings:
+			self.priority_messages = frozenset(mavframe.message_id(message) for message in settings['priority_messages'])
+		else:
+			self.priority_messages = default_priority_messages
+		self.priority_sources = frozenset(settings.get('priority_sources', ()))
+		# 'dscp': traffic class for the packets of udp and tcp endpoints
+		self.dscp = settings.get('dscp')
+		if self.dscp is not None:
+			self.dscp = int(self.dscp)
+			if not 0 <= self.dscp < 64:
+				raise ValueError("dscp must be between 0 and 63: %s" % self.dscp)
+
+		# 'filters': {target id: RouteFilter settings}
+		self.filters = {}
+		for target_id, filter_settings in settings.get('filters', {}).items():
+			self.filters[target_id] = RouteFilter(filter_settings)
+			if self.framing is None and ('allow' in filter_settings or 'deny' in filter_settings or 'rates' in filter_settings):
+				print("%s: message filters to %s need mavlink framing, only the byte rate applies" % (self.id, target_id))
+		self.set_connections(self.connections)
+
+		# 'dedup': drop inbound data seen in the last 'dedup_window'
+		# seconds, by MAVLink sysid/compid/seq/msgid ('seq') or by the
+		# hash of the data ('hash')
+		self.dedup_key = settings.get('dedup')
+		if self.dedup_key not in (None, 'seq', 'hash'):
+			raise ValueError("unknown dedup: %s" % self.dedup_key)
+		if self.dedup_key == 'seq' and self.framing is None:
+			raise ValueError("dedup by seq needs mavlink framing")
+		self.dedup = None
+		if self.dedup_key is not None:
+			self.dedup = DedupCache(float(settings.get('dedup_window', default_dedup_window)))
+
+		# 'capture': log file for everything read and written here, opened
+		# once the endpoint is in the registry (see start_capture())
+		self.capture_setting = settings.get('capture')
+		if registry.get(self.id) is self:
+			self.start_capture()
+
+
+	def start_capture(self):
+		self.set_capture(self.capture_setting)
+
+
+	def set_capture(self, path):
+		# endpoints capturing to the same path share one log
+		if path == self.capture_path:
+			return
+		if self.capture_path is not None:
+			close_capture(self.capture_path)
+		self.capture_path = path
+		self.capture = open_capture(path) if path is not None else None
+
+
+	def set_connections(self, connections):
+		self.connections = tuple(connections)
+		self.routes = tuple((endpoint, self.filters.get(endpoint.id)) for endpoint in self.connections)
+
+
+	def open(self):
+		pass
+
+
+	def close(self):
+		pass
+
+
+	def attach(self, fd):
+		self.fd = fd
+		self.events = 0 if self.paused else select.EPOLLIN
+		watch(fd, self.handle_events, self.events)
+
+
+	def detach(self):
+		if self.fd is not None:
+			unwatch(self.fd)
+		self.fd = None
+		self.events = 0
+		self.queue.clear()
+		self.urgent_queue.clear()
+		self.remainder = None
+		self.queued_bytes = 0
+		self.waiting = False
+		self.resume_sources()
+
+
+	def update_events(self):
+		if self.fd is None:
+			return
+		events = 0 if self.paused else select.EPOLLIN
+		if self.waiting:
+			events |= select.EPOLLOUT
+		if events != self.events:
+			self.events = events
+			modify(self.fd, events)
+
+
+	def handle_events(self, events):
+		if events & select.EPOLLOUT:
+			self.flush()
+		if events & ~select.EPOLLOUT:
+			self.read()
+
+
+	def write(self, data, urgent=False):
+		# queue data for the end of this wakeup, returns False if the
+		# writer should stop reading until the queue drains ('block' policy)
+		if self.fd is None:
+			self.stats.drops += 1
+			return True
+
+		if self.queued_bytes + len(data) > self.queue_size:
+			# priority traffic makes room for itself whatever the policy
+			if urgent:
+				self.drop_oldest(self.queue, len(data))
+			if self.queued_bytes + len(data) > self.queue_size:
+				if self.queue_policy == 'drop-newest' and (self.queue or self.urgent_queue):
+					self.stats.drops += 1
+					return True
+				if self.queue_policy == 'drop-oldest':
+					self.drop_oldest(self.queue, len(data))
+					self.drop_oldest(self.urgent_queue, len(data))
+
+		# queued with the time it was read, for the latency histogram
+		if urgent:
+			self.urgent_queue.append((data, wakeup_time))
+		else:
+			self.queue.append((data, wakeup_time))
+		self.queued_bytes += len(data)
+		if not self.pending and not self.waiting:
+			self.pending = True
+			pending.append(self)
+		return self.queued_bytes <= self.queue_size or self.queue_policy != 'block'
+
+
+	def drop_oldest(self, queue, size):
+		while queue and self.queued_bytes + size > self.queue_size:
+			self.queued_bytes -= len(queue.popleft()[0])
+			self.stats.drops += 1
+
+
+	def flush(self):
+		self.pending = False
+		queue = self.queue
+		urgent_queue = self.urgent_queue
+		stats = self.stats
+		now = monotonic()
+		while True:
+			if self.remainder is not None:
+				data, timestamp = self.remainder
+				self.remainder = None
+			elif urgent_queue:
+				data, timestamp = urgent_queue.popleft()
+			elif queue:
+				data, timestamp = queue.popleft()
+			else:
+				break
+
+			try:
+				sent = self.send(data)
+			except EnvironmentError as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					sent = 0
+				else:
+					print("%s write error: %s" % (self.id, e))
+					self.queued_bytes -= len(data)
+					stats.drops += 1
+					stats.errors += 1
+					self.write_failed(e)
+					continue
+
+			stats.bytes_out += sent
+			self.queued_bytes -= sent
+			if sent < len(data):
+				# come back when the fd is writable
+				self.remainder = (data[sent:], timestamp)
+				self.waiting = True
+				self.update_events()
+				return
+
+			stats.packets_out += 1
+			stats.add_latency(now - timestamp)
+			if debug:
+				print("%s write") % self.id
+
+		if self.waiting:
+			self.waiting = False
+			self.update_events()
+		self.resume_sources()
+
+
+	def send(self, data):
+		# write data to the fd, return the number of bytes written; fds are
+		# non-blocking, so short writes are fine. Sockets that need an
+		# address or a different call override this
+		return os.write(self.fd, data)
+
+
+	def write_failed(self, error):
+		pass
+
+
+	def block_on(self, target):
+		if self not in target.blocked_sources:
+			target.blocked_sources.append(self)
+		self.paused = True
+		self.update_events()
+
+
+	def resume_sources(self):
+		if not self.blocked_sources or self.queued_bytes > self.queue_size:
+			return
+		for source in self.blocked_sources:
+			source.paused = False
+			source.update_events()
+		self.blocked_sources = []
+
+
+	def forward(self, data, parser=None):
+		# parser is given by streams that share this endpoint's routes but
+		# keep their own framing state
+		self.stats.packets_in += 1
+		self.stats.bytes_in += len(data)
+
+		if self.capture is not None:
+			self.capture.write(wakeup_time, self.id, None, data)
+
+		if parser is None:
+			parser = self.parser
+
+		if parser is None:
+			if self.dedup is not None and self.dedup.seen(hash(data), wakeup_time):
+				return
+			# write data out on all outbound connections
+			for endpoint, route_filter in self.routes:
+				if route_filter is not None and not route_filter.accept(None, len(data), wakeup_time):
+					continue
+				if endpoint.capture is not None:
+					endpoint.capture.write(wakeup_time, self.id, endpoint.id, data)
+				if not endpoint.write(data, self.id in endpoint.priority_sources):
+					self.block_on(endpoint)
+			return
+
+		dedup = self.dedup
+		for frame in parser.parse(data):
+			if (frame.sysid, frame.compid) not in self.systems:
+				self.systems.add((frame.sysid, frame.compid))
+				self.system_ids.add(frame.sysid)
+			if dedup is not None:
+				if self.dedup_key == 'seq':
+					key = (frame.sysid, frame.compid, frame.seq, frame.msgid)
+				else:
+					key = hash(frame.data)
+				if dedup.seen(key, wakeup_time):
+					continue
+			self.route(frame)
+
+
+	def route(self, frame):
+		target_system = frame.target_system
+		msgid = frame.msgid
+		for endpoint, route_filter in self.routes:
+			if target_system and not endpoint.leads_to(target_system, frame.target_component):
+				continue
+			if route_filter is not None and not route_filter.accept(msgid, len(frame.data), wakeup_time):
+				continue
+			if endpoint.capture is not None:
+				endpoint.capture.write(wakeup_time, self.id, endpoint.id, frame.data)
+			urgent = msgid in endpoint.priority_messages or self.id in endpoint.priority_sources
+			if not endpoint.write(frame.data, urgent):
+				self.block_on(endpoint)
+
+
+	def leads_to(self, system, component):
+		# endpoints that haven't heard from any system get everything
+		if not self.systems:
+			return True
+		if component == 0:
+			return system in self.system_ids
+		return (system, component) in self.systems
+
+
+	def to_json(self):
+		configuration = {"id": self.id,
+				"type": self.type,
+				"connections": self.connectionIds}
+		if self.framing is not None:
+			configuration["framing"] = self.framing
+		if self.queue_size != default_queue_size:
+			configuration["queue_size"] = self.queue_size
+		if self.queue_policy != 'drop-oldest':
+			configuration["queue_policy"] = self.queue_policy
+		if self.priority_messages != default_priority_messages:
+			configuration["priority_messages"] = sorted(self.priority_messages)
+		if self.priority_sources:
+			configuration["priority_sources"] = sorted(self.priority_sources)
+		if self.dscp is not None:
+			configuration["dscp"] = self.dscp
+		if self.dedup is not None:
+			configuration["dedup"] = self.dedup_key
+			if self.dedup.window != default_dedup_window:
+				configuration["dedup_window"] = self.dedup.window
+		if self.capture_path is not None:
+			configuration["capture"] = self.capture_path
+		if self.filters:
+			configuration["filters"] = dict((target_id, route_filter.settings)
+					for target_id, route_filter in self.filters.items())
+		return configuration
+
+
+	def stats_json(self):
+		stats = self.stats.to_json()
+		stats["queue_depth"] = len(self.queue) + len(self.urgent_queue)
+		stats["queued_bytes"] = self.queued_bytes
+		if self.dedup is not None:
+			stats["duplicates"] = self.dedup.duplicates
+		if self.capture is not None:
+			stats["capture_dropped"] = self.capture.dropped
+		if self.filters:
+			stats["filtered"] = dict((target_id, route_filter.filtered)
+					for target_id, route_filter in self.filters.items())
+		return stats
 
 
 	def connect(self, target):
@@ -27,20 +851,173 @@ class Endpoint(object):
 		if target.id in self.connectionIds:
 			print("%s is already connected to %s") % (self.id, target.id)
 			return
-		self.connections.append(target)
 		self.connectionIds.append(target.id)
+		self.set_connections(self.connections + (target,))
 
 
 	def disconnect(self, target_id):
 		try:
 			self.connectionIds.remove(target_id)
-		except:
-			print("Error disconnecting %s") % target.id
+		except ValueError:
+			print("Error disconnecting %s") % target_id
 			return
 
-		for endpoint in self.connections:
-			if endpoint.id == target_id:
-				self.connections.remove(endpoint)
+		self.set_connections(endpoint for endpoint in self.connections if endpoint.id != target_id)
+
+
+class SerialWorkers(object):
+	# blocking reads and writes of one serial port, each in its own thread
+	# chunks cross over in bounded deques (append and popleft are atomic)
+	# and a pipe wakes the event loop, which sees it as the port's fd
+
+	def __init__(self, owner, fd):
+		self.owner = owner
+		self.fd = fd
+		self.inbound = collections.deque()
+		self.outbound = collections.deque()
+		self.error = None
+		self.running = True
+		# bytes the write thread has written, and how many of them the
+		# owner has been told about (see service())
+		self.written = 0
+		self.counted = 0
+
+		self.wakeup_fds = os.pipe()
+		self.stop_fds = os.pipe()
+		for wakeup_fd in self.wakeup_fds:
+			fcntl.fcntl(wakeup_fd, fcntl.F_SETFL, fcntl.fcntl(wakeup_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.inbound_space = threading.Event()
+		self.outbound_ready = threading.Event()
+
+		self.threads = [threading.Thread(target=self.read_worker, name='%s read' % owner.id),
+				threading.Thread(target=self.write_worker, name='%s write' % owner.id)]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+
+	def fileno(self):
+		return self.wakeup_fds[0]
+
+
+	def wake(self):
+		try:
+			os.write(self.wakeup_fds[1], b'\0')
+		except OSError:
+			# full, the loop has plenty of wakeups waiting already
+			pass
+
+
+	def fail(self, error):
+		self.error = error
+		self.wake()
+
+
+	def read_worker(self):
+		inbound = self.inbound
+		while self.running:
+			if len(inbound) >= thread_queue_length:
+				# the loop is behind, leave the data in the kernel
+				self.inbound_space.clear()
+				if len(inbound) >= thread_queue_length:
+					self.inbound_space.wait()
+				continue
+
+			if self.stop_fds[0] in select.select([self.fd, self.stop_fds[0]], [], [])[0]:
+				return
+			try:
+				data = os.read(self.fd, serial_read_size)
+			except OSError as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					continue
+				self.fail(e)
+				return
+			if not data:
+				# readable with nothing to read, the device is gone
+				self.fail(OSError(errno.EIO, os.strerror(errno.EIO)))
+				return
+			inbound.append(data)
+			self.wake()
+
+
+	def write_worker(self):
+		outbound = self.outbound
+		while True:
+			self.outbound_ready.wait()
+			if not self.running:
+				return
+			self.outbound_ready.clear()
+			while outbound:
+				if self.stop_fds[0] in select.select([self.stop_fds[0]], [self.fd], [])[0]:
+					return
+				data = outbound[0]
+				try:
+					written = os.write(self.fd, data)
+				except OSError as e:
+					if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+						continue
+					self.fail(e)
+					return
+				self.written += written
+				if written < len(data):
+					outbound[0] = data[written:]
+				else:
+					outbound.popleft()
+					# the loop may be waiting for room, and counts what
+					# was written
+					self.wake()
+
+
+	def send(self, data):
+		if len(self.outbound) >= thread_queue_length:
+			return 0
+		self.outbound.append(data)
+		self.outbound_ready.set()
+		return len(data)
+
+
+	def service(self):
+		# called by the event loop when the pipe is readable
+		try:
+			os.read(self.wakeup_fds[0], 4096)
+		except OSError:
+			pass
+
+		owner = self.owner
+		if self.error is not None:
+			print("%s error: %s" % (owner.id, self.error))
+			owner.stats.errors += 1
+			owner.reopen_later()
+			return
+
+		inbound = self.inbound
+		while inbound and not owner.paused:
+			# the rest is picked up when reading resumes (see
+			# SerialEndpoint.update_events())
+			owner.forward(inbound.popleft())
+			self.inbound_space.set()
+
+		written = self.written
+		if written != self.counted:
+			owner.stats.bytes_out += written - self.counted
+			owner.queued_bytes -= written - self.counted
+			self.counted = written
+			if owner.waiting:
+				if len(self.outbound) < thread_queue_length:
+					owner.flush()
+			else:
+				owner.resume_sources()
+
+
+	def stop(self):
+		self.running = False
+		os.write(self.stop_fds[1], b'\0')
+		self.inbound_space.set()
+		self.outbound_ready.set()
+		for thread in self.threads:
+			thread.join()
+		for fd in self.wakeup_fds + self.stop_fds:
+			os.close(fd)
 
 
 class SerialEndpoint(Endpoint):
@@ -50,6 +1027,15 @@ class SerialEndpoint(Endpoint):
 		self.port = port
 		self.baudrate = baudrate
 		self.active = False
+		self.reopen_timer = None
+		self.retry_interval = reopen_interval
+		# waiting for the port's device node, see wait_for_device()
+		self.device_watch = False
+		self.opened = False
+		self.reconnects = 0
+		# reads and writes in their own threads, see configure()
+		self.threaded = False
+		self.workers = None
 
 		# not a socket! just a port
 		self.socket = serial.Serial()
@@ -58,17 +1044,91 @@ class SerialEndpoint(Endpoint):
 		self.socket.timeout = 0
 
 
-	def read(self):
+	def open(self):
+		if self.reopen_timer is not None:
+			self.reopen_timer.cancel()
+			self.reopen_timer = None
 		try:
-			if not self.socket.is_open:
-				self.socket.open()
-				print('%s on %s:%s') % (self.id, self.port, self.baudrate)
-			data = self.socket.read(1024)
-			self.active = True
+			self.socket.open()
 		except Exception as e:
 			self.socket.close()
 			self.active = False
+			self.wait_for_device()
+			return
+
+		print('%s on %s:%s') % (self.id, self.port, self.baudrate)
+		if self.opened:
+			self.reconnects += 1
+		self.opened = True
+		self.active = True
+		self.retry_interval = reopen_interval
+		if self.threaded:
+			self.workers = SerialWorkers(self, self.socket.fileno())
+			self.attach(self.workers.fileno())
+			self.update_events()
+		else:
+			self.attach(self.socket.fileno())
+
+
+	def configure(self, settings):
+		Endpoint.configure(self, settings)
+		# 'threaded': read and write the port in threads of its own, so a
+		# driver that blocks holds up only this port
+		self.threaded = bool(settings.get('threaded', False))
+
+
+	def close(self):
+		if self.reopen_timer is not None:
+			self.reopen_timer.cancel()
+			self.reopen_timer = None
+		if self.device_watch:
+			cancel_device_node(self.port, self.device_changed)
+			self.device_watch = False
+		self.detach()
+		if self.workers is not None:
+			self.workers.stop()
+			self.workers = None
+		self.socket.close()
+		self.active = False
+
+
+	def reopen_later(self):
+		self.close()
+		self.wait_for_device()
+
+
+	def wait_for_device(self):
+		# the port is probably unplugged: open it again as soon as its
+		# device node is created (or udev fixes its permissions), with a
+		# slow retry in case that is missed
+		try:
+			wait_for_device_node(self.port, self.device_changed)
+			self.device_watch = True
+		except (EnvironmentError, AttributeError) as e:
+			# no inotify, the timer will have to do
+			pass
+		self.reopen_timer = call_later(self.retry_interval, self.open)
+		self.retry_interval = min(self.retry_interval * 2, max_reopen_interval)
+
+
+	def device_changed(self, mask):
+		# reopen_timer is only set while waiting for the device
+		if self.reopen_timer is not None:
+			self.open()
+
+
+	def read(self):
+		if self.workers is not None:
+			self.workers.service()
+			return
+
+		# timeout is 0, so this returns everything the port has buffered
+		try:
+			data = self.socket.read(serial_read_size)
+		except Exception as e:
 			#print("Error reading serial endpoint: %s") % e
+			self.stats.errors += 1
+			self.reopen_later()
 			return
 
 		if len(data) > 0:
@@ -77,124 +1137,1066 @@ class SerialEndpoint(Endpoint):
 				#print('%s read %s') % (self.id, data[:25].decode('utf-8'))
 				print('%s read') % self.id
 
-			# write data out on all outbound connections
-			for endpoint in self.connections:
-				endpoint.write(data)
+			self.forward(data)
 
 
-	def write(self, data):
-		try:
-			if self.socket.is_open:
-				self.socket.write(data)
+	def update_events(self):
+		if self.workers is None:
+			Endpoint.update_events(self)
+			return
+		if self.fd is None:
+			return
+		# the fd is the workers' wakeup pipe, which also brings errors and
+		# the write thread's progress: it is always read, and never waited
+		# on for writing
+		if self.events != select.EPOLLIN:
+			self.events = select.EPOLLIN
+			modify(self.fd, self.events)
+		if not self.paused and self.workers.inbound:
+			self.workers.wake()
+
+
+	def send(self, data):
+		if self.workers is not None:
+			sent = self.workers.send(data)
+			# not written yet: it stays queued, and is counted out once the
+			# write thread has written it (see SerialWorkers.service())
+			self.queued_bytes += sent
+			self.stats.bytes_out -= sent
+			return sent
+		return Endpoint.send(self, data)
+
+
+	def write_failed(self, error):
+		self.reopen_later()
+
+
+	def to_json(self):
+		configuration = Endpoint.to_json(self)
+		configuration.update({"port": self.port,
+				"baudrate": self.baudrate})
+		if self.threaded:
+			configuration["threaded"] = True
+		return configuration
+
+
+	def stats_json(self):
+		stats = Endpoint.stats_json(self)
+		stats["connected"] = self.active
+		stats["reconnects"] = self.reconnects
+		return stats
+
+
+class DatagramEndpoint(Endpoint):
+	# common part of udp and unix socket endpoints
+
+	def __init__(self, id, type, connections, sock, server):
+		Endpoint.__init__(self, id, type, connections)
+		self.socket = sock
+		self.socket.setblocking(False)
+		# datagrams are received here and copied out at their real size
+		self.buffer = bytearray(max_datagram_size)
+		self.view = memoryview(self.buffer)
+
+		# in server mode everyone who sends to us is a peer and gets
+		# everything we write, until they go quiet for peer_timeout
+		self.server = server
+		self.destination = None
+		self.peers = {}
+		self.peer_list = []
+		self.next_peer = 0
+		self.peer_timeout = default_peer_timeout
+		self.expiry_timer = None
+
+		# coalescing, see configure()
+		self.coalesce_window = 0
+		self.coalesce_size = default_coalesce_size
+		self.coalesce_max_delay = default_coalesce_max_delay
+		self.coalesce_timer = None
+		self.coalesced = 0
+
+
+	def configure(self, settings):
+		Endpoint.configure(self, settings)
+		self.peer_timeout = float(settings.get('peer_timeout', default_peer_timeout))
+		# 'coalesce_window': wait this long (seconds) after a packet for
+		# more to send with it in one datagram, up to 'coalesce_size'
+		# bytes and never longer than 'coalesce_max_delay' after the first
+		self.coalesce_window = float(settings.get('coalesce_window', 0))
+		self.coalesce_size = int(settings.get('coalesce_size', default_coalesce_size))
+		self.coalesce_max_delay = float(settings.get('coalesce_max_delay', default_coalesce_max_delay))
+
+
+	def open(self):
+		self.attach(self.socket.fileno())
+
+
+	def close(self):
+		if self.expiry_timer is not None:
+			self.expiry_timer.cancel()
+			self.expiry_timer = None
+		if self.coalesce_timer is not None:
+			self.coalesce_timer.cancel()
+			self.coalesce_timer = None
+		self.detach()
+		self.socket.close()
+
+
+	def format_address(self, address):
+		return "%s:%s" % address
+
+
+	def add_peer(self, address):
+		print("%s new peer %s" % (self.id, self.format_address(address)))
+		# at the end, so a fan-out waiting on the socket carries on where
+		# it was
+		self.peer_list.append(address)
+		if self.expiry_timer is None:
+			self.expiry_timer = call_later(self.peer_timeout, self.expire_peers)
+
+
+	def remove_peer(self, address):
+		del self.peers[address]
+		# keep a fan-out waiting on the socket pointed at the same peer
+		if self.peer_list.index(address) < self.next_peer:
+			self.next_peer -= 1
+		self.peer_list.remove(address)
+
+
+	def expire_peers(self):
+		self.expiry_timer = None
+		deadline = monotonic() - self.peer_timeout
+		for address, last_heard in list(self.peers.items()):
+			if last_heard < deadline:
+				print("%s peer %s timed out" % (self.id, self.format_address(address)))
+				self.remove_peer(address)
+
+		if self.peers:
+			oldest = min(self.peers.values())
+			self.expiry_timer = call_later(max(0, oldest - deadline), self.expire_peers)
+
+
+	def read(self):
+		# drain the socket until it would block
+		for i in range(max_read_batch):
+			try:
+				nbytes, address = self.socket.recvfrom_into(self.buffer)
+			except socket.error as e:
+				# ECONNREFUSED is an icmp error from an earlier send
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED):
+					print("%s read error: %s" % (self.id, e))
+					self.stats.errors += 1
+				return
+
+			# unbound unix sockets have no address to answer to
+			if self.server and address:
+				if address not in self.peers:
+					self.add_peer(address)
+				self.peers[address] = wakeup_time
+
+			if nbytes > 0:
 				if debug:
-					print('%s write %s') % (self.id, data[:25])
+					#print('%s read %s on %s') % (self.id, data[:25], address)
+					print("%s read") % self.id
 
-		# serial.SerialException
-		except Exception as e:
-			print("Error writing: %s") % e
+				self.forward(self.view[:nbytes].tobytes())
+
+			if self.paused:
+				return
+
+
+	def flush(self):
+		if self.coalesce_window and self.remainder is None:
+			if self.coalesce_hold():
+				self.pending = False
+				return
+			self.coalesce(self.urgent_queue)
+			self.coalesce(self.queue)
+		Endpoint.flush(self)
+
+
+	def coalesce_hold(self):
+		# True if the queue should wait for more packets, priority
+		# traffic and a full datagram's worth go right away
+		queue = self.queue
+		if self.urgent_queue or not queue or self.queued_bytes >= self.coalesce_size:
+			return False
+		now = monotonic()
+		deadline = min(queue[-1][1] + self.coalesce_window, queue[0][1] + self.coalesce_max_delay)
+		if now >= deadline:
+			return False
+		if self.coalesce_timer is None:
+			self.coalesce_timer = call_later(deadline - now, self.coalesce_due)
+		return True
+
+
+	def coalesce_due(self):
+		self.coalesce_timer = None
+		self.flush()
+
+
+	def coalesce(self, queue):
+		# join queued packets into datagrams of up to coalesce_size bytes,
+		# each stamped with the time of its oldest packet
+		if len(queue) < 2:
 			return
+		datagrams = []
+		parts = []
+		size = 0
+		for data, timestamp in queue:
+			if parts and size + len(data) > self.coalesce_size:
+				datagrams.append((b''.join(parts), oldest))
+				parts = []
+				size = 0
+			if not parts:
+				oldest = timestamp
+			parts.append(data)
+			size += len(data)
+		datagrams.append((b''.join(parts), oldest))
+		self.coalesced += len(queue) - len(datagrams)
+		queue.clear()
+		queue.extend(datagrams)
+
+
+	def send(self, data):
+		if not self.server:
+			return self.sendto(data, self.destination)
+
+		# fan out to every peer, if one would block we pick up from
+		# the same peer when the socket is writable again
+		peers = self.peer_list
+		while self.next_peer < len(peers):
+			address = peers[self.next_peer]
+			self.next_peer += 1
+			try:
+				self.sendto(data, address)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					self.next_peer -= 1
+				else:
+					# the packet is dropped, the next starts from the top
+					self.next_peer = 0
+				raise
+		self.next_peer = 0
+		return len(data)
+
+
+	def sendto(self, data, address):
+		# only raises if the socket would block, a peer we can't reach
+		# shouldn't cost the others the packet
+		try:
+			return self.socket.sendto(data, address)
+		except socket.error as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+			# ECONNREFUSED is an icmp error from an earlier send
+			if e.errno != errno.ECONNREFUSED:
+				print("%s write error: %s" % (self.id, e))
+				self.stats.errors += 1
+			return len(data)
 
 
 	def to_json(self):
-		return {"id": self.id,
-				"type": self.type,
-				"port": self.port,
-				"baudrate": self.baudrate,
-				"connections": self.connectionIds};
+		configuration = Endpoint.to_json(self)
+		if self.peer_timeout != default_peer_timeout:
+			configuration["peer_timeout"] = self.peer_timeout
+		if self.coalesce_window:
+			configuration["coalesce_window"] = self.coalesce_window
+		if self.coalesce_size != default_coalesce_size:
+			configuration["coalesce_size"] = self.coalesce_size
+		if self.coalesce_max_delay != default_coalesce_max_delay:
+			configuration["coalesce_max_delay"] = self.coalesce_max_delay
+		return configuration
 
 
-class UDPEndpoint(Endpoint):
+	def stats_json(self):
+		stats = Endpoint.stats_json(self)
+		if self.coalesce_window:
+			stats["coalesced"] = self.coalesced
+		if self.server:
+			stats["peers"] = [self.format_address(address) for address in self.peer_list]
+		return stats
+
+
+class UDPEndpoint(DatagramEndpoint):
 
 	def __init__(self, ip, port, id, connections):
-		Endpoint.__init__(self, id, 'udp', connections)
 		self.ip = ip
 		self.port = port
-		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		self.socket.setblocking(False)
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		DatagramEndpoint.__init__(self, id, 'udp', connections, sock, ip == '0.0.0.0')
+		try:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, udp_receive_buffer)
+		except socket.error:
+			pass
 		print('%s on %s:%s') % (self.id, self.ip, self.port)
-		if (self.ip == '0.0.0.0'):
+
+		if self.server:
 			print('binding')
 			self.socket.bind((ip, int(port)))
+		else:
+			self.destination = (ip, int(port))
+
+
+	def open(self):
+		set_dscp(self.socket, self.dscp)
+		DatagramEndpoint.open(self)
+
+
+	def to_json(self):
+		configuration = DatagramEndpoint.to_json(self)
+		configuration.update({"port": self.port,
+				"ip": self.ip})
+		return configuration
+
+
+class MulticastEndpoint(DatagramEndpoint):
+	# receives what is sent to group:port and sends to it, so only hosts
+	# that joined the group get the traffic (unlike subnet broadcast)
+	# packets go out from a second socket, so our own can be told apart
+	# when 'loopback' hands them back to us
+
+	def __init__(self, group, port, id, connections):
+		self.group = group
+		self.port = port
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		DatagramEndpoint.__init__(self, id, 'multicast', connections, sock, False)
+		# other programs on this computer may listen to the group too
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		try:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, udp_receive_buffer)
+		except socket.error:
+			pass
+		print('%s on %s:%s') % (self.id, self.group, self.port)
+		self.socket.bind((group, int(port)))
+		self.destination = (group, int(port))
+
+		self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.send_socket.setblocking(False)
+		self.own_port = None
+		self.own_addresses = frozenset()
+
+		# see configure()
+		self.ttl = 1
+		self.interface = None
+		self.loopback = True
+
+
+	def configure(self, settings):
+		DatagramEndpoint.configure(self, settings)
+		# 'ttl': how many routers the packets may cross, 1 keeps them on
+		# the local network
+		self.ttl = int(settings.get('ttl', 1))
+		# 'interface': address of the interface to join and send on,
+		# otherwise the kernel picks one by the routing table
+		self.interface = settings.get('interface')
+		# 'loopback': whether programs on this computer get our packets
+		self.loopback = bool(settings.get('loopback', True))
+
+
+	def open(self):
+		interface = self.interface or '0.0.0.0'
+		membership = socket.inet_aton(self.group) + socket.inet_aton(interface)
+		self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+		self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+		self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(self.loopback))
+		if self.interface is not None:
+			self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+		set_dscp(self.send_socket, self.dscp)
+		self.send_socket.bind((interface, 0))
+		self.own_port = self.send_socket.getsockname()[1]
+		self.own_addresses = self.source_addresses()
+		DatagramEndpoint.open(self)
+
+
+	def source_addresses(self):
+		# addresses our packets can come back from: the interface's, or
+		# with none set any of this computer's, as the kernel picks one
+		# per packet by the routing table
+		if self.interface is not None:
+			return frozenset([self.interface])
+		addresses = local_addresses()
+		probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			probe.connect((self.group, int(self.port)))
+			addresses.add(probe.getsockname()[0])
+		except socket.error:
+			pass
+		finally:
+			probe.close()
+		return frozenset(addresses)
+
+
+	def close(self):
+		DatagramEndpoint.close(self)
+		self.send_socket.close()
+
 
 	def read(self):
+		# the same as DatagramEndpoint.read(), less what we sent ourselves
+		for i in range(max_read_batch):
+			try:
+				nbytes, address = self.socket.recvfrom_into(self.buffer)
+			except socket.error as e:
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					print("%s read error: %s" % (self.id, e))
+					self.stats.errors += 1
+				return
+
+			if address[1] == self.own_port and address[0] in self.own_addresses:
+				continue
+
+			if nbytes > 0:
+				self.forward(self.view[:nbytes].tobytes())
+
+			if self.paused:
+				return
+
+
+	def sendto(self, data, address):
 		try:
-			data, address = self.socket.recvfrom(1024)
-			self.destination = address
-		except:
-			return
+			return self.send_socket.sendto(data, address)
+		except socket.error as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				# epoll is watching the other socket, so don't wait
+				self.stats.drops += 1
+			else:
+				print("%s write error: %s" % (self.id, e))
+				self.stats.errors += 1
+			return len(data)
 
-		if len(data) > 0:
-			if debug:
-				#print('%s read %s on %s') % (self.id, data[:25], address)
-				print("%s read") % self.id
 
-			for endpoint in self.connections:
-				endpoint.write(data)
+	def to_json(self):
+		configuration = DatagramEndpoint.to_json(self)
+		configuration.update({"port": self.port,
+				"group": self.group})
+		if self.ttl != 1:
+			configuration["ttl"] = self.ttl
+		if self.interface is not None:
+			configuration["interface"] = self.interface
+		if not self.loopback:
+			configuration["loopback"] = False
+		return configuration
+
+
+class UnixEndpoint(DatagramEndpoint):
+	# unix datagram socket at 'path' for consumers on this computer, they
+	# bind their own socket and send to path to become a peer
+	# with 'shm' set, packets for the peers go into a shared memory ring at
+	# that path instead, and each peer gets one empty datagram per wakeup
+	# to say there is something new in it
+
+	def __init__(self, path, id, connections):
+		self.path = path
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		DatagramEndpoint.__init__(self, id, 'unix', connections, sock, True)
+		self.shm = None
+		self.shm_size = shmring.default_capacity
+		self.ring = None
+		self.ring_written = False
+		print('%s on %s') % (self.id, self.path)
+		# a socket left behind by the last run is replaced, anything else
+		# at path is probably a typo and stays
+		try:
+			mode = os.lstat(path).st_mode
+		except OSError:
+			mode = None
+		if mode is not None:
+			if not stat.S_ISSOCK(mode):
+				self.socket.close()
+				raise ValueError("%s exists and isn't a socket" % path)
+			os.unlink(path)
+		self.socket.bind(path)
+
+
+	def configure(self, settings):
+		DatagramEndpoint.configure(self, settings)
+		self.shm = settings.get('shm')
+		self.shm_size = int(settings.get('shm_size', shmring.default_capacity))
+
+
+	def open(self):
+		if self.shm is not None:
+			self.ring = shmring.Writer(self.shm, self.shm_size)
+		DatagramEndpoint.open(self)
+
+
+	def close(self):
+		DatagramEndpoint.close(self)
+		if self.ring is not None:
+			self.ring.close()
+			self.ring = None
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+
+	def format_address(self, address):
+		return address
+
+
+	def send(self, data):
+		if self.ring is None:
+			return DatagramEndpoint.send(self, data)
+		if self.peer_list:
+			try:
+				self.ring.write(data)
+				self.ring_written = True
+			except ValueError:
+				self.stats.drops += 1
+		return len(data)
+
+
+	def flush(self):
+		DatagramEndpoint.flush(self)
+		if self.ring_written:
+			self.ring_written = False
+			for address in list(self.peer_list):
+				self.sendto(b'', address)
+
 
-	def write(self, data):
+	def sendto(self, data, address):
 		try:
-			if (self.ip == '0.0.0.0'):
-				self.socket.sendto(data, self.destination)
+			return self.socket.sendto(data, address)
+		except socket.error as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				# the peer isn't keeping up, epoll can't tell us when it
+				# will, so don't let it hold up the others
+				self.stats.drops += 1
+			elif e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+				print("%s peer %s went away" % (self.id, address))
+				self.remove_peer(address)
 			else:
-				self.socket.sendto(data, (self.ip, int(self.port)))
+				raise
+			return len(data)
 
-			if debug:
-				#print('%s write %s') % (self.id, data[:25])
-				print("%s write") % self.id
 
-		except Exception as e:
-			print e
-			return
+	def to_json(self):
+		configuration = DatagramEndpoint.to_json(self)
+		configuration["path"] = self.path
+		if self.shm is not None:
+			configuration["shm"] = self.shm
+		if self.shm_size != shmring.default_capacity:
+			configuration["shm_size"] = self.shm_size
+		return configuration
+
+
+def configure_tcp_socket(sock, dscp):
+	sock.setblocking(False)
+	set_dscp(sock, dscp)
+	sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	# notice dead peers (e.g. a cut tether) within about 30 s
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+	for option, value in (('TCP_KEEPIDLE', 10), ('TCP_KEEPINTVL', 5), ('TCP_KEEPCNT', 4)):
+		if hasattr(socket, option):
+			sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class TCPStream(Endpoint):
+	# one connected tcp socket belonging to a tcp endpoint
+	# it has its own queue, so a slow client only holds up itself
+
+	def __init__(self, owner, sock, address):
+		Endpoint.__init__(self, owner.id, 'tcp-stream', [])
+		self.owner = owner
+		self.socket = sock
+		self.address = address
+		self.queue_size = owner.queue_size
+		self.queue_policy = owner.queue_policy
+		self.paused = owner.paused
+		# counted as the owner's traffic
+		self.stats = owner.stats
+		if owner.parser is not None:
+			self.parser = mavframe.FrameParser()
+		configure_tcp_socket(sock, owner.dscp)
+
+
+	def open(self):
+		self.attach(self.socket.fileno())
+
+
+	def close(self):
+		self.detach()
+		self.socket.close()
+
+
+	def read(self):
+		for i in range(max_read_batch):
+			try:
+				data = self.socket.recv(tcp_read_size)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					return
+				print("%s read error: %s" % (self.id, e))
+				self.stats.errors += 1
+				data = None
+
+			if not data:
+				self.owner.stream_closed(self)
+				return
+
+			self.owner.forward(data, self.parser)
+			if self.paused:
+				return
+
+
+	def send(self, data):
+		return self.socket.send(data)
+
+
+	def write_failed(self, error):
+		self.owner.stream_closed(self)
+
+
+	def resume_sources(self):
+		Endpoint.resume_sources(self)
+		self.owner.resume_sources()
+
+
+class TCPEndpoint(Endpoint):
+	# common part of tcp-server and tcp-client: inbound data from every
+	# stream is routed as this endpoint's, writes go to every stream
+
+	def __init__(self, ip, port, id, type, connections):
+		Endpoint.__init__(self, id, type, connections)
+		self.ip = ip
+		self.port = port
+		self.streams = []
+
+
+	def add_stream(self, sock, address):
+		print("%s connected to %s:%s" % (self.id, address[0], address[1]))
+		stream = TCPStream(self, sock, address)
+		self.streams.append(stream)
+		stream.open()
+
+
+	def stream_closed(self, stream):
+		print("%s disconnected from %s:%s" % (self.id, stream.address[0], stream.address[1]))
+		stream.close()
+		self.streams.remove(stream)
+
+
+	def close(self):
+		for stream in self.streams:
+			stream.close()
+		self.streams = []
+		self.detach()
+
+
+	def write(self, data, urgent=False):
+		accepted = True
+		for stream in self.streams:
+			if not stream.write(data, urgent):
+				accepted = False
+		return accepted
+
+
+	def update_events(self):
+		# pausing this endpoint pauses reading from its streams, a
+		# listening socket keeps accepting
+		for stream in self.streams:
+			stream.paused = self.paused
+			stream.update_events()
+
+
+	def resume_sources(self):
+		for stream in self.streams:
+			if stream.queued_bytes > stream.queue_size:
+				return
+		Endpoint.resume_sources(self)
 
 
 	def to_json(self):
-		return {"id": self.id,
-				"type": self.type,
-				"port": self.port,
-				"ip": self.ip,
-				"connections": self.connectionIds};
+		configuration = Endpoint.to_json(self)
+		configuration.update({"port": self.port,
+				"ip": self.ip})
+		return configuration
 
 
-def add(new_endpoint):
-	for existing_endpoint in endpoints:
-		if new_endpoint.id == existing_endpoint.id:
-			print("Error adding endpoint %s, id already exists") % new_endpoint.id
+	def stats_json(self):
+		stats = Endpoint.stats_json(self)
+		stats["queue_depth"] = sum(len(stream.queue) + len(stream.urgent_queue) for stream in self.streams)
+		stats["queued_bytes"] = sum(stream.queued_bytes for stream in self.streams)
+		stats["clients"] = ["%s:%s" % stream.address[:2] for stream in self.streams]
+		return stats
+
+
+class TCPServerEndpoint(TCPEndpoint):
+
+	def __init__(self, ip, port, id, connections):
+		TCPEndpoint.__init__(self, ip, port, id, 'tcp-server', connections)
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.socket.setblocking(False)
+		print('%s listening on %s:%s') % (self.id, self.ip, self.port)
+		self.socket.bind((ip, int(port)))
+		self.socket.listen(8)
+
+
+	def open(self):
+		self.attach(self.socket.fileno())
+
+
+	def close(self):
+		TCPEndpoint.close(self)
+		self.socket.close()
+
+
+	def read(self):
+		# the listening socket is readable, accept everyone waiting
+		while True:
+			try:
+				sock, address = self.socket.accept()
+			except socket.error as e:
+				if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+					print("%s accept error: %s" % (self.id, e))
+					self.stats.errors += 1
+				return
+			self.add_stream(sock, address)
+
+
+class TCPClientEndpoint(TCPEndpoint):
+
+	def __init__(self, ip, port, id, connections):
+		TCPEndpoint.__init__(self, ip, port, id, 'tcp-client', connections)
+		self.socket = None
+		self.connect_timer = None
+		self.retry_interval = reconnect_interval
+
+
+	def open(self):
+		self.dial()
+
+
+	def close(self):
+		if self.connect_timer is not None:
+			self.connect_timer.cancel()
+			self.connect_timer = None
+		TCPEndpoint.close(self)
+		if self.socket is not None:
+			unwatch(self.socket.fileno())
+			self.socket.close()
+			self.socket = None
+
+
+	def dial(self):
+		self.connect_timer = None
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		configure_tcp_socket(self.socket, self.dscp)
+		try:
+			error = self.socket.connect_ex((self.ip, int(self.port)))
+		except socket.error as e:
+			self.connect_failed(e)
+			return
+		if error not in (0, errno.EINPROGRESS):
+			self.connect_failed(os.strerror(error))
 			return
-	for existing_endpoint in endpoints:
-		if new_endpoint.id in existing_endpoint.connectionIds:
-			existing_endpoint.connections.append(new_endpoint)
-		if existing_endpoint.id in new_endpoint.connectionIds:
-			new_endpoint.connections.append(existing_endpoint)
+		# writable once the connection is made or has failed
+		watch(self.socket.fileno(), self.handle_connect, select.EPOLLOUT)
 
-	endpoints.append(new_endpoint)
 
+	def handle_connect(self, events):
+		unwatch(self.socket.fileno())
+		error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if error:
+			self.connect_failed(os.strerror(error))
+			return
+
+		sock = self.socket
+		self.socket = None
+		self.retry_interval = reconnect_interval
+		self.add_stream(sock, (self.ip, int(self.port)))
+
+
+	def connect_failed(self, reason):
+		if debug:
+			print("%s connect to %s:%s failed: %s" % (self.id, self.ip, self.port, reason))
+		self.socket.close()
+		self.socket = None
+		self.connect_timer = call_later(self.retry_interval, self.dial)
+		self.retry_interval = min(self.retry_interval * 2, max_reconnect_interval)
+
+
+	def stream_closed(self, stream):
+		TCPEndpoint.stream_closed(self, stream)
+		if self.connect_timer is None:
+			self.connect_timer = call_later(self.retry_interval, self.dial)
+
+
+# SIOCGIFCONF: list the interfaces that have an address, as struct ifreq
+_SIOCGIFCONF = 0x8912
+# name, then a union whose largest member is two longs, a short and 3
+# chars (padded to a long)
+_ifreq_size = 16 + struct.calcsize('@LLH3B0L')
+
+
+def local_addresses():
+	# ipv4 addresses of this computer's interfaces, looked up every time
+	# as they come and go (dhcp, usb tethers)
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		buffer = array.array('B', b'\0' * (_ifreq_size * 64))
+		address, size = buffer.buffer_info()
+		request = struct.pack('iL', size, address)
+		size = struct.unpack('iL', fcntl.ioctl(sock.fileno(), _SIOCGIFCONF, request))[0]
+	except IOError:
+		return set()
+	finally:
+		sock.close()
+	data = buffer.tostring()
+	# ifr_addr is a struct sockaddr_in: family, port, address
+	return set(socket.inet_ntoa(data[offset + 20:offset + 24])
+			for offset in range(0, size, _ifreq_size))
+
+
+def _local(ip):
+	return (ip in ('0.0.0.0', 'localhost') or ip.startswith('127.') or
+			ip in local_addresses())
+
+
+def _reaches(client, server):
+	# client sends to an address server is listening on, on this computer
+	return int(client.port) == int(server.port) and (client.ip == server.ip or
+			(_local(client.ip) and server.ip == '0.0.0.0'))
+
+
+def wired(a, b):
+	# True if what endpoint a sends out comes back in through endpoint b
+	# servers answer their clients, so those are wired both ways
+	if a.type == b.type == 'udp':
+		if not a.server and b.server:
+			return _reaches(a, b)
+		if a.server and not b.server:
+			return _reaches(b, a)
+	elif a.type == 'tcp-client' and b.type == 'tcp-server':
+		return _reaches(a, b)
+	elif a.type == 'tcp-server' and b.type == 'tcp-client':
+		return _reaches(b, a)
+	elif a.type == b.type == 'multicast':
+		return a.loopback and a.group == b.group and int(a.port) == int(b.port)
+	elif a.type == b.type == 'unix':
+		# unix endpoints only answer peers, they can't reach each other
+		# unless they share a socket, where whichever bound last gets
+		# what was meant for the other
+		return a is not b and os.path.realpath(a.path) == os.path.realpath(b.path)
+	return False
+
+
+# routes left out by update_routes(), each reported once
+loops = set()
+
+
+def find_loop(source, target, connections):
+	# if source forwarding to target would send data round in circles
+	# (out of target, back in through an endpoint wired to it, on through
+	# connections {id: [endpoint]} and so on back to source), returns the
+	# ids along the way
+	stack = [[source.id, target.id, endpoint] for endpoint in endpoints if wired(target, endpoint)]
+	seen = set()
+	while stack:
+		path = stack.pop()
+		endpoint = path[-1]
+		path[-1] = endpoint.id
+		if endpoint is source:
+			return path
+		if endpoint.id in seen:
+			continue
+		seen.add(endpoint.id)
+		for next_target in connections.get(endpoint.id, ()):
+			for wired_endpoint in endpoints:
+				if wired(next_target, wired_endpoint):
+					stack.append(path + [next_target.id, wired_endpoint])
+	return None
+
+
+def update_routes():
+	# connectionIds may name endpoints that don't exist (yet), routes
+	# that would make a loop are left out
+	global loops
+	connections = {}
+	found = set()
+	for endpoint in endpoints:
+		routes = connections[endpoint.id] = []
+		for id in endpoint.connectionIds:
+			target = registry.get(id)
+			if target is None:
+				continue
+			loop = find_loop(endpoint, target, connections)
+			if loop is not None:
+				found.add(tuple(loop))
+				if tuple(loop) not in loops:
+					print("not routing %s to %s, it would loop: %s" % (endpoint.id, id, ' > '.join(loop)))
+				continue
+			routes.append(target)
+	loops = found
 
-def remove(endpoint_id):
-	remove = None
 	for endpoint in endpoints:
-		if endpoint.id == endpoint_id:
-			remove = endpoint
-			break
+		endpoint.set_connections(connections[endpoint.id])
 
+
+def add(new_endpoint):
+	if new_endpoint.id in registry:
+		print("Error adding endpoint %s, id already exists") % new_endpoint.id
+		return
+
+	endpoints.append(new_endpoint)
+	registry[new_endpoint.id] = new_endpoint
+	new_endpoint.start_capture()
+	update_routes()
+	new_endpoint.open()
+
+
+def remove(endpoint_id):
+	remove = registry.pop(endpoint_id, None)
 	if remove is None:
 		print("Error removing endpoint %s, id doesn't exist") % endpoint_id
 		return
 
 	print("remove: %s") % remove
+	endpoints.remove(remove)
+	for endpoint in endpoints:
+		if endpoint_id in endpoint.connectionIds:
+			endpoint.connectionIds.remove(endpoint_id)
+	update_routes()
+
 	try:
-		remove.socket.close()
-		endpoints.remove(remove)
+		remove.close()
 		print("removed endpoint %s") % remove.id
+	except Exception as e:
+		print("Error removing: %s") % e
+	remove.set_capture(None)
 
 
-		for endpoint in endpoints:
-			endpoint.connections.remove(remove)
-			endpoint.connections.connectionIds.remove(remove.id)
+def clear():
+	for endpoint in endpoints:
+		endpoint.close()
+		endpoint.set_capture(None)
+	del endpoints[:]
+	registry.clear()
+
+
+# what each optional setting is when it isn't given, so a configuration
+# that spells out a default compares equal to one that leaves it out
+setting_defaults = {
+	'framing': None,
+	'queue_size': default_queue_size,
+	'queue_policy': 'drop-oldest',
+	'priority_sources': [],
+	'dscp': None,
+	'dedup': None,
+	'capture': None,
+	'filters': {},
+	'threaded': False,
+	'peer_timeout': default_peer_timeout,
+	'coalesce_window': 0,
+	'coalesce_size': default_coalesce_size,
+	'coalesce_max_delay': default_coalesce_max_delay,
+	'ttl': 1,
+	'interface': None,
+	'loopback': True,
+	'shm': None,
+	'shm_size': shmring.default_capacity,
+}
+
+# settings an open endpoint can't change: a new value means closing it and
+# opening another, anything else is applied in place by configure()
+reopen_settings = frozenset(('type', 'port', 'baudrate', 'ip', 'group', 'path',
+		'dscp', 'threaded', 'ttl', 'interface', 'loopback', 'shm', 'shm_size'))
+
+_unset = object()
+
+
+def _settings(endpoint_json):
+	# endpoint_json without its connections and the settings at their default
+	settings = dict((key, value) for key, value in endpoint_json.items()
+			if key != 'connections' and setting_defaults.get(key, _unset) != value)
+	if 'priority_messages' in settings:
+		try:
+			ids = sorted(mavframe.message_id(message) for message in settings['priority_messages'])
+		except (KeyError, ValueError):
+			ids = settings['priority_messages']
+		if ids == sorted(default_priority_messages):
+			del settings['priority_messages']
+		else:
+			settings['priority_messages'] = ids
+	if 'priority_sources' in settings:
+		settings['priority_sources'] = sorted(settings['priority_sources'])
+	if settings.get('dedup') is None or settings.get('dedup_window') == default_dedup_window:
+		settings.pop('dedup_window', None)
+	return settings
+
+
+def apply(configuration):
+	# make the running endpoints match configuration, only endpoints whose
+	# socket or port settings changed are closed and opened again, the
+	# others keep them and are reconfigured in place
+	wanted = configuration['endpoints']
+	wanted_ids = set(endpoint_json['id'] for endpoint_json in wanted)
+
+	for endpoint in list(endpoints):
+		if endpoint.id not in wanted_ids:
+			print("removing %s") % endpoint.id
+			_close(endpoint)
+
+	updated = []
+	opened = []
+	for endpoint_json in wanted:
+		existing = registry.get(endpoint_json['id'])
+		if existing is not None:
+			current_json = existing.to_json()
+			current = _settings(current_json)
+			settings = _settings(endpoint_json)
+			changed = set(key for key in set(current) | set(settings)
+					if current.get(key) != settings.get(key))
+			if not changed & reopen_settings:
+				if changed:
+					print("%s changed, reconfiguring") % existing.id
+					try:
+						existing.configure(endpoint_json)
+					except Exception as e:
+						print("Error configuring %s: %s") % (existing.id, e)
+						existing.configure(current_json)
+				existing.connectionIds = list(endpoint_json['connections'])
+				updated.append(existing)
+				continue
+			print("%s changed, reopening") % existing.id
+			_close(existing)
+
+		try:
+			new_endpoint = from_json(endpoint_json)
+		except Exception as e:
+			print("Error adding endpoint %s: %s") % (endpoint_json.get('id'), e)
+			continue
+		registry[new_endpoint.id] = new_endpoint
+		new_endpoint.start_capture()
+		updated.append(new_endpoint)
+		opened.append(new_endpoint)
+
+	endpoints[:] = updated
+	update_routes()
+	failed = False
+	for endpoint in opened:
+		try:
+			endpoint.open()
+		except Exception as e:
+			print("Error opening %s: %s") % (endpoint.id, e)
+			_close(endpoint)
+			failed = True
+	if failed:
+		update_routes()
 
 
+def _close(endpoint):
+	del registry[endpoint.id]
+	endpoints.remove(endpoint)
+	try:
+		endpoint.close()
 	except Exception as e:
-		#print("Error removing: %s") % e
-		pass
+		print("Error removing: %s") % e
+	endpoint.set_capture(None)
 
 
 def to_json(endpoint_id=None):
@@ -204,6 +2206,16 @@ def to_json(endpoint_id=None):
 	configuration = {"endpoints": configuration}
 	return json.dumps(configuration, indent=4)
 
+def stats_json(endpoint_id=None):
+	stats = {}
+	if endpoint_id is None:
+		for endpoint in endpoints:
+			stats[endpoint.id] = endpoint.stats_json()
+	elif endpoint_id in registry:
+		stats[endpoint_id] = registry[endpoint_id].stats_json()
+	return json.dumps({"stats": stats})
+
+
 def from_json(endpoint_json):
 	if endpoint_json['type'] == 'serial':
 		new_endpoint = SerialEndpoint(
@@ -219,36 +2231,66 @@ def from_json(endpoint_json):
 							endpoint_json['id'],
 							endpoint_json['connections'])
 
+	elif endpoint_json['type'] == 'multicast':
+		new_endpoint = MulticastEndpoint(
+							endpoint_json['group'],
+							endpoint_json['port'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+
+	elif endpoint_json['type'] == 'unix':
+		new_endpoint = UnixEndpoint(
+							endpoint_json['path'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+
+	elif endpoint_json['type'] == 'tcp-server':
+		new_endpoint = TCPServerEndpoint(
+							endpoint_json['ip'],
+							endpoint_json['port'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+
+	elif endpoint_json['type'] == 'tcp-client':
+		new_endpoint = TCPClientEndpoint(
+							endpoint_json['ip'],
+							endpoint_json['port'],
+							endpoint_json['id'],
+							endpoint_json['connections'])
+
+	else:
+		raise ValueError("unknown endpoint type: %s" % endpoint_json['type'])
+
+	new_endpoint.configure(endpoint_json)
 	return new_endpoint
 
 
 def connect(source_id, target_id):
-	source = None
-	target = None
-	for endpoint in endpoints:
-		if endpoint.id == source_id:
-			source = endpoint
-		if endpoint.id == target_id:
-			target = endpoint
+	source = registry.get(source_id)
+	target = registry.get(target_id)
 
 	if source is None:
 		print("Error: source %s is not present") % source_id
+		return
 
 	if target is None:
 		print("Error: target %s is not present") % target_id
+		return
+
+	loop = find_loop(source, target, dict((endpoint.id, endpoint.connections) for endpoint in endpoints))
+	if loop is not None:
+		print("Error: connecting %s to %s would make a loop: %s" % (source_id, target_id, ' > '.join(loop)))
+		return
 
 	source.connect(target)
 
 
 def disconnect(source_id, target_id):
-	source = None
-
-	for endpoint in endpoints:
-		if endpoint.id == source_id:
-			source = endpoint
+	source = registry.get(source_id)
 
 	if source is None:
 		print("Error: source %s is not present") % source_id
+		return
 
 	#it's ok if target does not exist, it may still be a desired endpoint
 
@@ -259,10 +2301,110 @@ def get_endpoints():
 	return endpoints
 
 
+def write_file(filename, text):
+	# write a new file next to the old one and rename it into place, so
+	# losing power half way leaves either the old or the new file intact
+	directory = os.path.dirname(os.path.abspath(filename))
+	fd, temporary = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.', dir=directory)
+	try:
+		os.fchmod(fd, 0o644)
+		remaining = text
+		while remaining:
+			remaining = remaining[os.write(fd, remaining):]
+		os.fsync(fd)
+	except:
+		os.close(fd)
+		os.unlink(temporary)
+		raise
+	os.close(fd)
+	os.rename(temporary, filename)
+	_written[os.path.abspath(filename)] = text
+
+	fd = os.open(directory, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
 def save(filename):
-	f = open(filename, 'w+')
-	f.write(to_json())
-	f.close()
+	write_file(filename, to_json())
+
+
+# what we last wrote to each file, so auto_reload() can ignore our own saves
+_written = {}
+_reload_timers = {}
+
+
+def reload(filename):
+	try:
+		f = open(filename, 'r')
+		configuration = json.load(f)
+		f.close()
+	except Exception as e:
+		print("Error loading from file %s: %s") % (filename, e)
+		return
+
+	apply(configuration)
+
+
+def auto_reload(filename):
+	# apply filename whenever someone else changes it
+	filename = os.path.abspath(filename)
+
+	def changed(mask):
+		if _reload_timers.get(filename) is None:
+			_reload_timers[filename] = call_later(reload_delay, reload_changed)
+
+	def reload_changed():
+		_reload_timers[filename] = None
+		try:
+			with open(filename, 'r') as f:
+				text = f.read()
+		except IOError:
+			return
+		if text == _written.get(filename):
+			return
+		print("%s changed, reloading") % filename
+		try:
+			apply(json.loads(text))
+		except Exception as e:
+			print("Error loading from file %s: %s") % (filename, e)
+
+	on_file_change(filename, changed)
+
+
+# save_async() hands the configuration to this thread to write, so a slow
+# sd card never holds up forwarding. Only the latest configuration for each
+# file is kept, a burst of changes is written once.
+_saves = {}
+_saves_changed = threading.Condition()
+_save_thread = None
+
+
+def _save_worker():
+	while True:
+		with _saves_changed:
+			while not _saves:
+				_saves_changed.wait()
+			filename, text = _saves.popitem()
+		try:
+			write_file(filename, text)
+		except Exception as e:
+			print("Error saving to file %s: %s") % (filename, e)
+
+
+def save_async(filename):
+	global _save_thread
+	text = to_json()
+	with _saves_changed:
+		_saves[filename] = text
+		_saves_changed.notify()
+
+	if _save_thread is None:
+		_save_thread = threading.Thread(target=_save_worker, name='save')
+		_save_thread.daemon = True
+		_save_thread.start()
 
 
 def load(filename):
@@ -276,21 +2418,6 @@ def load(filename):
 
 	for endpoint in configuration['endpoints']:
 		try:
-			if endpoint['type'] == 'serial':
-				new_endpoint = SerialEndpoint(
-									endpoint['port'],
-									endpoint['baudrate'],
-									endpoint['id'],
-									endpoint['connections'])
-
-			elif endpoint['type'] == 'udp':
-				new_endpoint = UDPEndpoint(
-									endpoint['ip'],
-									endpoint['port'],
-									endpoint['id'],
-									endpoint['connections'])
-
-			add(new_endpoint)
-
+			add(from_json(endpoint))
 		except Exception as e:
 			print(e)
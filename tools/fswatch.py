@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# Minimal inotify binding
+# The watcher's fd can be polled like a socket, read() returns what changed.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct('iIII')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.inotify_init1.argtypes = [ctypes.c_int]
+_libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+_libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+
+class Watcher(object):
+
+    def __init__(self):
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+
+    def fileno(self):
+        return self.fd
+
+
+    def add(self, path, mask):
+        """
+        Start watching path, returns the watch descriptor that read() will
+        report its events with. Watching the same path again returns the
+        same descriptor with the new mask.
+        """
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        return _check(_libc.inotify_add_watch(self.fd, path, mask))
+
+
+    def remove(self, wd):
+        _check(_libc.inotify_rm_watch(self.fd, wd))
+
+
+    def read(self):
+        """
+        Returns a list of (wd, mask, name) for everything pending
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if not isinstance(name, str):
+                    name = name.decode('utf-8', 'replace')
+                events.append((wd, mask, name))
+
+
+    def close(self):
+        os.close(self.fd)
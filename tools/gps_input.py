@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Where nmea-receiver and underwater-gps send their GPS_INPUT
+# Both build a dict of GPS_INPUT fields. JSONOutput sends it to MAVProxy's
+# GPSInput module on udp 25100 the way they always have, MAVLinkOutput
+# packs the GPS_INPUT message itself and sends it straight to the router
+# or autopilot, without the JSON and the trip through MAVProxy. Only
+# MAVLinkOutput needs pymavlink.
+
+import json
+import socket
+
+json_address = ('127.0.0.1', 25100)
+
+# MAVProxy's default udpin, forwarded on to the autopilot
+default_device = 'udpout:localhost:9000'
+
+# system id GPS_INPUT is sent as: a ground station's, not the vehicle's
+# own (1), which the autopilot would take for another vehicle with its id
+default_source_system = 255
+
+# GPS_INPUT fields and what they are when not given
+defaults = {
+    'time_usec': 0,
+    'gps_id': 0,
+    'ignore_flags': 0,
+    'time_week_ms': 0,
+    'time_week': 0,
+    'fix_type': 3,
+    'lat': 0,
+    'lon': 0,
+    'alt': 0,
+    'hdop': 0,
+    'vdop': 0,
+    'vn': 0,
+    've': 0,
+    'vd': 0,
+    'speed_accuracy': 0,
+    'horiz_accuracy': 0,
+    'vert_accuracy': 0,
+    'satellites_visible': 0,
+}
+
+# fields that are integers in the message
+integer_fields = ('time_usec', 'gps_id', 'ignore_flags', 'time_week_ms', 'time_week',
+                  'fix_type', 'lat', 'lon', 'satellites_visible')
+
+
+class JSONOutput(object):
+
+    def __init__(self, sock=None, address=json_address):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+        self.socket = sock
+        self.address = address
+
+
+    def send(self, fields):
+        self.socket.sendto(json.dumps(fields), self.address)
+
+
+class MAVLinkOutput(object):
+
+    def __init__(self, device=default_device, source_system=default_source_system,
+                 source_component=None):
+        from pymavlink import mavutil
+        self.mavlink = mavutil.mavlink
+        if source_component is None:
+            source_component = mavutil.mavlink.MAV_COMP_ID_GPS
+        self.master = mavutil.mavlink_connection(device, source_system=source_system,
+                                                 source_component=source_component)
+
+
+    def send(self, fields):
+        values = dict(defaults)
+        for field in defaults:
+            if field in fields:
+                values[field] = fields[field]
+        for field in integer_fields:
+            values[field] = int(round(values[field]))
+        self.master.mav.gps_input_send(**values)
+
+
+    def set_gps_type(self, gps_type=14):
+        # what the screen command does through MAVProxy, for when there
+        # isn't one
+        self.master.mav.param_set_send(1, 1, b'GPS_TYPE', gps_type,
+                                       self.mavlink.MAV_PARAM_TYPE_INT8)
+
+
+def add_arguments(parser):
+    parser.add_argument('--output', action="store", choices=['json', 'mavlink'], default='json', help="send GPS_INPUT as JSON to MAVProxy (udp 25100) or as MAVLink to --mavlink")
+    parser.add_argument('--mavlink', action="store", type=str, default=default_device, help="MAVLink connection to send GPS_INPUT to with --output mavlink, e.g. the router's udp endpoint or the autopilot's serial port")
+    parser.add_argument('--source-system', action="store", type=int, default=default_source_system, help="MAVLink system id to send GPS_INPUT as with --output mavlink (default %d)" % default_source_system)
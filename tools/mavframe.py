@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+# Incremental MAVLink v1/v2 frame parser
+# Raw bytes go in, whole frames come out. The message definitions from
+# pymavlink are used (when it's installed) to check the CRC of each frame
+# and to find the target_system/target_component fields for routing.
+
+import re
+import struct
+
+try:
+    from pymavlink.dialects.v20 import ardupilotmega as mavlink
+except ImportError:
+    mavlink = None
+
+STX_V1 = 0xFE
+STX_V2 = 0xFD
+
+HEADER_LEN_V1 = 6
+HEADER_LEN_V2 = 10
+CHECKSUM_LEN = 2
+SIGNATURE_LEN = 13
+
+INCOMPAT_FLAG_SIGNED = 0x01
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for i in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _crc_table()
+
+
+def x25crc(data, start, end, crc=0xFFFF):
+    """
+    MAVLink (CRC-16/MCRF4XX) checksum of data[start:end], data is a bytearray
+    """
+    table = _CRC_TABLE
+    for i in range(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xFF]
+    return crc
+
+
+def _message_table():
+    """
+    {msgid: (crc_extra, target_system offset, target_component offset)}
+    offsets are into the payload, or None if the message has no such field
+    """
+    table = {}
+    if mavlink is None:
+        return table
+
+    for msgid, message in mavlink.mavlink_map.items():
+        offsets = {}
+        offset = 0
+        fields = re.findall(r'(\d*)([a-zA-Z])', message.format[1:])
+        for name, (count, kind) in zip(message.ordered_fieldnames, fields):
+            offsets[name] = offset
+            offset += struct.calcsize('<' + count + kind)
+        table[msgid] = (message.crc_extra,
+                        offsets.get('target_system'),
+                        offsets.get('target_component'))
+    return table
+
+messages = _message_table()
+
+
+def _message_ids():
+    ids = {}
+    if mavlink is not None:
+        for msgid, message in mavlink.mavlink_map.items():
+            ids[getattr(message, 'msgname', None) or message.name] = msgid
+    return ids
+
+message_ids = _message_ids()
+
+
+def message_id(message):
+    """
+    Message id from an id or a name, e.g. 0, '0' or 'HEARTBEAT'
+    """
+    try:
+        return int(message)
+    except ValueError:
+        pass
+    try:
+        return message_ids[message.upper()]
+    except KeyError:
+        raise ValueError("unknown MAVLink message: %s" % message)
+
+
+class Frame(object):
+
+    __slots__ = ('data', 'msgid', 'sysid', 'compid', 'seq', 'target_system', 'target_component')
+
+    def __init__(self, data, msgid, sysid, compid, seq, target_system, target_component):
+        self.data = data
+        self.msgid = msgid
+        self.sysid = sysid
+        self.compid = compid
+        self.seq = seq
+        # 0 means broadcast
+        self.target_system = target_system
+        self.target_component = target_component
+
+
+class FrameParser(object):
+    """
+    Feed it chunks of a byte stream, get back the complete frames in them.
+    Partial frames are kept until the rest arrives, anything that isn't
+    MAVLink is thrown away.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped_bytes = 0
+        self.bad_crc = 0
+
+
+    def parse(self, data):
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+        start = 0
+        end = len(buf)
+
+        while start < end:
+            stx = buf[start]
+            if stx != STX_V1 and stx != STX_V2:
+                # skip to the next start of frame
+                next_v1 = buf.find(b'\xfe', start)
+                next_v2 = buf.find(b'\xfd', start)
+                candidates = [i for i in (next_v1, next_v2) if i >= 0]
+                skip_to = min(candidates) if candidates else end
+                self.dropped_bytes += skip_to - start
+                start = skip_to
+                continue
+
+            if stx == STX_V1:
+                header_len = HEADER_LEN_V1
+            else:
+                header_len = HEADER_LEN_V2
+
+            if end - start < header_len:
+                break
+
+            payload_len = buf[start + 1]
+            frame_len = header_len + payload_len + CHECKSUM_LEN
+            if stx == STX_V1:
+                seq = buf[start + 2]
+                sysid = buf[start + 3]
+                compid = buf[start + 4]
+                msgid = buf[start + 5]
+            else:
+                if buf[start + 2] & INCOMPAT_FLAG_SIGNED:
+                    frame_len += SIGNATURE_LEN
+                seq = buf[start + 4]
+                sysid = buf[start + 5]
+                compid = buf[start + 6]
+                msgid = buf[start + 7] | (buf[start + 8] << 8) | (buf[start + 9] << 16)
+
+            if end - start < frame_len:
+                break
+
+            payload = start + header_len
+            target_system = 0
+            target_component = 0
+            message = messages.get(msgid)
+            if message is not None:
+                crc_end = payload + payload_len
+                crc = x25crc(buf, start + 1, crc_end)
+                crc = x25crc(bytearray((message[0],)), 0, 1, crc)
+                if crc != buf[crc_end] | (buf[crc_end + 1] << 8):
+                    # not a real frame, resync on the next byte
+                    self.bad_crc += 1
+                    self.dropped_bytes += 1
+                    start += 1
+                    continue
+
+                # v2 payloads have their trailing zeros truncated
+                if message[1] is not None and message[1] < payload_len:
+                    target_system = buf[payload + message[1]]
+                if message[2] is not None and message[2] < payload_len:
+                    target_component = buf[payload + message[2]]
+
+            frames.append(Frame(bytes(buf[start:start + frame_len]), msgid, sysid, compid, seq,
+                                target_system, target_component))
+            start += frame_len
+
+        del buf[:start]
+        return frames
@@ -1,17 +1,37 @@
 #!/usr/bin/python
 
+import argparse
+import os
 import time
-import pynmea2
-import json
+import select
 import socket
 from os import system
 
+import serial
+
+import devwatch
+import gps_input
+import nmea_parser
+
+parser = argparse.ArgumentParser(description="forwards NMEA positions to the autopilot as GPS_INPUT")
+parser.add_argument('--mode', action="store", choices=['event', 'fixed'], default='event', help="send each fix as soon as it is complete (event) or at a fixed rate")
+parser.add_argument('--min-interval', action="store", type=float, default=0.05, help="event mode: least time between outputs, in seconds")
+parser.add_argument('--interval', action="store", type=float, default=0.1, help="fixed mode: time between outputs, in seconds")
+parser.add_argument('--report', action="store", type=float, default=10, help="seconds between latency reports, 0 for none")
+parser.add_argument('--serial', action="append", default=[], metavar="PORT[:BAUD]", help="also read NMEA from this serial port (default 115200 baud), reopened whenever it is plugged back in")
+parser.add_argument('--priority', action="append", default=[], metavar="SOURCE=N", help="priority of a source, by name (udp:IP:PORT, tcp:IP:PORT, serial:PORT) or kind (udp, tcp, serial); higher wins, default 0")
+gps_input.add_arguments(parser)
+parser.add_argument('--stale', action="store", type=float, default=0, help="seconds without a fix before a source is failed over from (default: one fix interval and a quarter)")
+args = parser.parse_args()
+
 # destination / output
-ip="127.0.0.1"
-portnum = 25100
-sockitOut = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sockitOut.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-sockitOut.setblocking(False)
+if args.output == 'mavlink':
+    gps_output = gps_input.MAVLinkOutput(args.mavlink, args.source_system)
+else:
+    sockitOut = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sockitOut.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sockitOut.setblocking(False)
+    gps_output = gps_input.JSONOutput(sockitOut)
 
 # UDP source
 sockitUdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -23,9 +43,7 @@ sockitUdp.bind(('0.0.0.0', 27000))
 sockitTcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 sockitTcp.setblocking(False)
 sockitTcp.bind(('0.0.0.0', 27001))
-sockitTcp.listen(1)
-
-parser = pynmea2.NMEAStreamReader()
+sockitTcp.listen(5)
 
 data = {
     'time_usec' : 0,                        # (uint64_t) Timestamp (micros since boot or Unix epoch)
@@ -48,78 +66,399 @@ data = {
     'satellites_visible' : 0                # (uint8_t) Number of satellites visible.
 }
 
-data_received = False
-gps_type_set = False
-last_output_t = 0;
+last_output_t = 0
+
+# fix-to-output latencies since the last report
+latencies = []
+last_report_t = time.time()
+
+# GGA fix quality, ranked: rtk fixed > rtk float > dgps > gps > the rest
+quality_rank = {4: 5, 5: 4, 2: 3, 1: 2, 3: 1}
+
+# a source is stale once a fix is this much of its interval late
+stale_margin = 0.25
+
+# udp senders that go quiet this long are forgotten
+udp_forget_time = 60.0
+
+# most read from a serial port at once
+serial_read_size = 4096
+
+priorities = {}
+for setting in args.priority:
+    name, priority = setting.rsplit('=', 1)
+    priorities[name] = int(priority)
+
+
+class Source(object):
+    """
+    One stream of NMEA: a udp sender, a tcp client or a serial port, with
+    its own parser and the latest fix it gave. Sentences with the same time
+    belong to one epoch (one fix), which is complete once every type the
+    receiver sent last epoch has arrived.
+    """
+
+    def __init__(self, kind, name, sock=None):
+        self.kind = kind
+        self.name = name
+        self.socket = sock
+        self.priority = priorities.get(name, priorities.get(kind, 0))
+        self.nmea = nmea_parser.NMEAParser()
+        self.values = {}
+
+        self.epoch_time = None
+        self.epoch_types = set()
+        self.expected_types = set(['GGA', 'RMC'])
+        # when the first sentence of the epoch was received
+        self.epoch_received = 0
+        self.epoch_pending = False
+
+        # when the last complete epoch was, and the time between them
+        self.last_fix = None
+        self.fix_interval = None
+        # when the oldest fix not sent yet was received
+        self.unsent_received = None
+        self.last_data = time.time()
+
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+    def feed(self, datagram, received):
+        # returns True if an epoch completed
+        self.last_data = received
+        completed = False
+        for sentence_type, values in self.nmea.parse(datagram):
+            complete = self.update(sentence_type, values, received)
+            if complete is None:
+                continue
+            completed = True
+            if self.last_fix is not None:
+                interval = received - self.last_fix
+                self.fix_interval = interval if self.fix_interval is None else 0.8 * self.fix_interval + 0.2 * interval
+            self.last_fix = received
+            if self.unsent_received is None:
+                self.unsent_received = complete
+        return completed
+
+
+    def update(self, sentence_type, values, received):
+        # returns when the first sentence of an epoch that is now complete
+        # was received, None if there isn't one
+        complete = None
+        fix_time = values.get('time')
+        if fix_time is not None and fix_time != self.epoch_time:
+            if self.epoch_pending:
+                # the last epoch never completed, settle for what it had
+                complete = self.epoch_received
+            if self.epoch_types:
+                # wait for what the last epoch had, so a type the receiver
+                # stops sending is dropped and one it starts again is back
+                self.expected_types = self.epoch_types
+            self.epoch_time = fix_time
+            self.epoch_types = set()
+            self.epoch_received = received
+            self.epoch_pending = True
+
+        for field in ('lat', 'lon', 'hdop', 'alt', 'satellites_visible', 'fix_quality', 'valid'):
+            if field in values:
+                self.values[field] = values[field]
+
+        if fix_time is not None:
+            self.epoch_types.add(sentence_type)
+            if self.epoch_pending and self.epoch_types >= self.expected_types:
+                self.epoch_pending = False
+                complete = self.epoch_received
+        return complete
+
+
+    def stale_at(self):
+        # when the source goes stale if no fix comes in, None if it is
+        # already without one
+        if self.last_fix is None:
+            return None
+        limit = args.stale or (1 + stale_margin) * (self.fix_interval or 0.5)
+        return self.last_fix + limit
+
+
+    def stale(self, now):
+        stale_at = self.stale_at()
+        return stale_at is None or now > stale_at
+
+
+    def rank(self, now):
+        # fresh, usable fixes first, then priority, then fix quality;
+        # the selected source wins ties so equal sources don't flap
+        usable = 'lat' in self.values and self.values.get('valid', True) and self.values.get('fix_quality', 1) != 0
+        return (usable and not self.stale(now),
+                self.priority,
+                quality_rank.get(self.values.get('fix_quality', 1), 0),
+                self is selected,
+                self.last_fix or 0)
+
+
+    def close(self):
+        if self.kind != 'udp':
+            self.socket.close()
+
+
+class SerialPort(object):
+    """
+    A serial port given with --serial. It has a Source while it is open,
+    and is opened again when it comes back after being unplugged.
+    """
 
-# wait for connection
-def waitConnection():
-    while True:
+    def __init__(self, setting):
+        self.port, _, baudrate = setting.partition(':')
+        self.baudrate = int(baudrate or 115200)
+        self.name = 'serial:' + self.port
+        self.source = None
+        self.retry_interval = devwatch.retry_interval
+        # when to try opening the port again, None while it is open
+        self.reopen_at = 0
+
+
+    def open(self):
         try:
-            sockit, addr = sockitTcp.accept()
-            print("TCP connected!")
-            return sockit
-        except:
-            print("TCP not connected, waiting for data")
+            port_serial = serial.Serial(self.port, self.baudrate, timeout=0)
+        except (serial.SerialException, OSError) as e:
+            if self.retry_interval == devwatch.retry_interval:
+                print("Can't open %s, waiting for it: %s" % (self.port, e))
+            self.wait_for_device()
+            return None
+        try:
+            # usb-serial adapters hold on to what they receive for up to
+            # 16 ms before passing it on, unless told not to
+            port_serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, ValueError, IOError):
+            # not a driver that has the setting
+            pass
+
+        print("Reading NMEA from %s at %d baud" % (self.port, self.baudrate))
+        self.retry_interval = devwatch.retry_interval
+        self.reopen_at = None
+        self.source = Source('serial', self.name, port_serial)
+        sources.append(self.source)
+        return self.source
+
+
+    def lost(self):
+        self.source = None
+        self.wait_for_device()
+
 
+    def wait_for_device(self):
+        # open it again once its device node is created (or udev fixes its
+        # permissions), with a slow retry in case that is missed
+        global watcher
         try:
-            sockitUdp.recvfrom(4096)
-            sockit = sockitUdp
-            print("UDP connected!")
-            return sockitUdp
-        except:
-            print("UDP not connected, waiting for data")
+            if watcher is None:
+                watcher = devwatch.DeviceWatcher()
+            watcher.wait(self.port, self.device_changed)
+        except (EnvironmentError, AttributeError):
+            # no inotify, the retry will have to do
+            pass
+        self.reopen_at = time.time() + self.retry_interval
+        self.retry_interval = min(self.retry_interval * 2, devwatch.max_retry_interval)
+
+
+    def device_changed(self, mask):
+        if self.source is None:
+            self.open()
+
+
+def read(source):
+    # returns what was read, None when the source is gone
+    if source.kind == 'serial':
+        # the port is non-blocking: everything it has buffered, in one go
+        data = os.read(source.fileno(), serial_read_size)
+        if not data:
+            # readable but empty, it has been unplugged
+            return None
+        return data
+    datagram = source.socket.recv(4096) # for TCP, it will return None when remote hangs up
+    if not datagram:
+        return None
+    return datagram
+
+
+def output(source):
+    global last_output_t
+    last_output_t = time.time()
+    values = source.values
+    if 'lat' in values:
+        data['lat'] = values['lat'] * 1e7
+        data['lon'] = values['lon'] * 1e7
+    for field in ('hdop', 'alt', 'satellites_visible'):
+        if field in values:
+            data[field] = values[field]
+    print("Sending: ", data)
+    gps_output.send(data)
+    if source.unsent_received:
+        latencies.append(last_output_t - source.unsent_received)
+    source.unsent_received = None
+
 
-        time.sleep(1) # 1 Hz update before connected
+def report():
+    global last_report_t, latencies
+    last_report_t = time.time()
+    if not latencies:
+        return
+    latencies.sort()
+    print("fix to output latency over %d fixes: p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        len(latencies),
+        latencies[len(latencies) // 2] * 1e3,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e3,
+        latencies[-1] * 1e3))
+    latencies = []
 
-sockit = waitConnection()
+
+def select_source(now):
+    global selected
+    if not sources:
+        selected = None
+        return None
+    best = max(sources, key=lambda source: source.rank(now))
+    if best is not selected:
+        print("Using %s" % best.name)
+        selected = best
+    return best
+
+
+def remove(source):
+    global selected
+    sources.remove(source)
+    if source.kind == 'udp':
+        del udp_sources[source.name]
+    else:
+        source.close()
+    if source.kind == 'serial':
+        serial_ports[source.name].lost()
+    if source is selected:
+        selected = None
+
+
+# every source heard from, udp senders are also kept by address
+sources = []
+udp_sources = {}
+selected = None
+
+serial_ports = {}
+watcher = None
+for setting in args.serial:
+    port = SerialPort(setting)
+    serial_ports[port.name] = port
+    port.open()
 
 # setup gps type parameter
-system('screen -S mavproxy -p 0 -X stuff "param set GPS_TYPE 14^M"')
+if args.output == 'mavlink':
+    gps_output.set_gps_type()
+else:
+    system('screen -S mavproxy -p 0 -X stuff "param set GPS_TYPE 14^M"')
 
-while sockit:
+# output as soon as the selected source completes an epoch but no more
+# often than min-interval (event mode), or every interval (fixed mode)
+output_due = None
 
-    time.sleep(0.05) # 20 Hz update once connected
+while True:
 
+    now = time.time()
+    if args.mode == 'fixed':
+        output_due = last_output_t + args.interval
+    timeout = None if output_due is None else max(0, output_due - now)
+    if args.report:
+        report_due = max(0, last_report_t + args.report - now)
+        timeout = report_due if timeout is None else min(timeout, report_due)
+    for port in serial_ports.values():
+        if port.reopen_at is not None:
+            reopen_due = max(0, port.reopen_at - now)
+            timeout = reopen_due if timeout is None else min(timeout, reopen_due)
+    # fail over as soon as the selected source misses a fix, rather than
+    # when another one completes an epoch
+    stale_due = selected.stale_at() if selected is not None else None
+    if stale_due is not None and stale_due >= now:
+        stale_due = stale_due - now + 0.001
+        timeout = stale_due if timeout is None else min(timeout, stale_due)
+
+    watched = [sockitUdp, sockitTcp] + [source for source in sources if source.kind != 'udp']
+    if watcher is not None:
+        watched.append(watcher)
     try:
-        datagram = sockit.recv(4096) # This blocks for UDP, for TCP, it will return None when remote hangs up
-
-        if not datagram: # TCP disconnect
-            print("Remote has hung up")
-            sockit.shutdown(socket.SHUT_RDWR)
-            sockit.close()
-            sockit = waitConnection()
-        else:
-            for byte in datagram:
-                for msg in parser.next(byte):
-                    if msg.sentence_type == 'GGA':
-                        data['lat'] = msg.latitude * 1e7
-                        data['lon'] = msg.longitude * 1e7
-                        data['hdop'] = float(msg.horizontal_dil)
-                        data['alt'] = float(msg.altitude)
-                        data['satellites_visible'] = int(msg.num_sats)
-                    elif msg.sentence_type == 'RMC':
-                        data['lat'] = msg.latitude * 1e7
-                        data['lon'] = msg.longitude * 1e7
-                    elif msg.sentence_type == 'GLL':
-                        data['lat'] = msg.latitude * 1e7
-                        data['lon'] = msg.longitude * 1e7
-                    elif msg.sentence_type == 'GNS':
-                        data['lat'] = msg.latitude * 1e7
-                        data['lon'] = msg.longitude * 1e7
-                        data['satellites_visible'] = int(msg.num_sats)
-                        data['hdop'] = float(msg.hdop)
-
-            if time.time() > last_output_t + 0.1:
-                last_output_t = time.time();
-                buf = json.dumps(data)
-                print("Sending: ", data)
-                sockitOut.sendto(buf, (ip, portnum))
-
-    except socket.error as e:
-        if e.errno == 11:
-            pass
-        else:
-            print("Error:", e)
-    except Exception as e:
-        print("Got error:", e)
+        readable = select.select(watched, [], [], timeout)[0]
+    except select.error as e:
+        continue
+
+    for ready in readable:
+        if ready is sockitTcp:
+            try:
+                sockit, addr = sockitTcp.accept()
+            except socket.error:
+                continue
+            sockit.setblocking(False)
+            print("TCP connected: %s:%d" % addr)
+            sources.append(Source('tcp', 'tcp:%s:%d' % addr, sockit))
+            continue
+        if ready is watcher:
+            watcher.handle_events()
+            continue
+
+        source = ready
+        try:
+            if ready is sockitUdp:
+                datagram, addr = sockitUdp.recvfrom(4096)
+                name = 'udp:%s:%d' % addr
+                source = udp_sources.get(name)
+                if source is None:
+                    print("UDP connected: %s:%d" % addr)
+                    source = Source('udp', name, sockitUdp)
+                    udp_sources[name] = source
+                    sources.append(source)
+            else:
+                datagram = read(source)
+                if datagram is None:
+                    print("%s has hung up" % source.name)
+                    remove(source)
+                    continue
+
+            received = time.time()
+            if source.feed(datagram, received) and args.mode == 'event':
+                # a source that completes an epoch may be one failing over
+                if select_source(received) is source and output_due is None:
+                    output_due = max(received, last_output_t + args.min_interval)
+
+        except (socket.error, OSError) as e:
+            if e.errno == 11:
+                pass
+            else:
+                print("Error:", e)
+                if isinstance(source, Source) and source.kind != 'udp':
+                    remove(source)
+        except Exception as e:
+            print("Got error:", e)
+
+    now = time.time()
+    for port in serial_ports.values():
+        if port.reopen_at is not None and now >= port.reopen_at:
+            port.open()
+    for source in list(udp_sources.values()):
+        if now - source.last_data > udp_forget_time:
+            print("%s has gone quiet" % source.name)
+            remove(source)
+
+    if selected is not None and selected.stale(now) and args.mode == 'event':
+        # in fixed mode the next output selects again
+        source = select_source(now)
+        if source is not None and not source.stale(now) and output_due is None:
+            output_due = max(now, last_output_t + args.min_interval)
+
+    if output_due is not None and now >= output_due:
+        output_due = None
+        source = select_source(now)
+        if source is not None and source.last_fix is not None:
+            output(source)
+        elif args.mode == 'fixed':
+            # nothing to send yet, look again next interval
+            last_output_t = now
+    if args.report and now >= last_report_t + args.report:
+        report()
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+# Bulk NMEA 0183 parser
+# Chunks of a byte stream go in, the position fields of the GGA, RMC, GLL
+# and GNS sentences in it come out. Whole lines are split off at once and
+# only the fields GPS_INPUT needs are decoded. Sentences that don't decode
+# are handed to pynmea2 (when it's installed) before being given up on.
+
+import functools
+import operator
+
+try:
+    import pynmea2
+except ImportError:
+    pynmea2 = None
+
+# longest sentence kept while waiting for its end (NMEA says 82)
+max_line_length = 1024
+
+# RMC/GLL status and GNS mode indicators that mean the position is no good
+_INVALID = ('V', 'N')
+
+
+def checksum(body):
+    """
+    XOR of the characters of body, the part between $ and *
+    """
+    return functools.reduce(operator.xor, bytearray(body), 0)
+
+
+def _degrees(value, hemisphere):
+    # ddmm.mmmm (or dddmm.mmmm) to signed degrees
+    if not value:
+        return None
+    point = value.find('.')
+    if point < 0:
+        point = len(value)
+    degrees = float(value[:point - 2]) + float(value[point - 2:]) / 60.0
+    if hemisphere in ('S', 'W'):
+        return -degrees
+    return degrees
+
+
+def _seconds(value):
+    # hhmmss.sss to seconds since midnight
+    if not value:
+        return None
+    return int(value[0:2]) * 3600 + int(value[2:4]) * 60 + float(value[4:])
+
+
+def _position(values, fields, lat):
+    latitude = _degrees(fields[lat], fields[lat + 1])
+    longitude = _degrees(fields[lat + 2], fields[lat + 3])
+    if latitude is not None and longitude is not None:
+        values['lat'] = latitude
+        values['lon'] = longitude
+
+
+def _gga(fields):
+    values = {'time': _seconds(fields[1])}
+    _position(values, fields, 2)
+    if fields[6]:
+        values['fix_quality'] = int(fields[6])
+    if fields[7]:
+        values['satellites_visible'] = int(fields[7])
+    if fields[8]:
+        values['hdop'] = float(fields[8])
+    if fields[9]:
+        values['alt'] = float(fields[9])
+    return values
+
+
+def _rmc(fields):
+    values = {'time': _seconds(fields[1]), 'valid': fields[2] == 'A'}
+    _position(values, fields, 3)
+    if fields[7]:
+        # knots
+        values['speed'] = float(fields[7]) * 0.514444
+    if fields[8]:
+        values['course'] = float(fields[8])
+    if fields[9]:
+        values['date'] = fields[9]
+    return values
+
+
+def _gll(fields):
+    values = {}
+    _position(values, fields, 1)
+    if len(fields) > 5:
+        values['time'] = _seconds(fields[5])
+    if len(fields) > 6:
+        values['valid'] = fields[6] == 'A'
+    return values
+
+
+def _gns(fields):
+    values = {'time': _seconds(fields[1]),
+              # one mode character per constellation
+              'valid': any(mode not in _INVALID for mode in fields[6])}
+    _position(values, fields, 2)
+    if fields[7]:
+        values['satellites_visible'] = int(fields[7])
+    if fields[8]:
+        values['hdop'] = float(fields[8])
+    if fields[9]:
+        values['alt'] = float(fields[9])
+    return values
+
+
+# sentence type: (decoder, fewest fields it needs)
+decoders = {
+    'GGA': (_gga, 10),
+    'RMC': (_rmc, 10),
+    'GLL': (_gll, 5),
+    'GNS': (_gns, 10),
+}
+
+
+def _from_pynmea2(sentence_type, line):
+    # the same values as the decoders above, from pynmea2's parse
+    message = pynmea2.parse(line)
+    values = {}
+    if getattr(message, 'latitude', None) is not None and message.lat:
+        values['lat'] = message.latitude
+        values['lon'] = message.longitude
+    timestamp = getattr(message, 'timestamp', None)
+    if timestamp is not None:
+        values['time'] = timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second + timestamp.microsecond / 1e6
+    if sentence_type in ('GGA', 'GNS'):
+        if getattr(message, 'num_sats', None):
+            values['satellites_visible'] = int(message.num_sats)
+        if getattr(message, 'altitude', None) is not None:
+            values['alt'] = float(message.altitude)
+    if sentence_type == 'GGA':
+        if message.gps_qual is not None:
+            values['fix_quality'] = int(message.gps_qual)
+        if message.horizontal_dil:
+            values['hdop'] = float(message.horizontal_dil)
+    if sentence_type == 'GNS' and message.hdop:
+        values['hdop'] = float(message.hdop)
+    return values
+
+
+class NMEAParser(object):
+    """
+    Feed it chunks of a byte stream, get back (sentence type, values) for
+    the complete GGA/RMC/GLL/GNS sentences in them. Sentences with a bad
+    checksum or that can't be decoded are counted and skipped, partial
+    lines are kept until the rest arrives.
+    """
+
+    def __init__(self):
+        self.buffer = b''
+        self.sentences = 0
+        self.bad_checksum = 0
+        self.errors = 0
+
+
+    def parse(self, data):
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > max_line_length:
+            self.buffer = b''
+
+        results = []
+        for line in lines:
+            start = line.find(b'$')
+            if start < 0:
+                continue
+            end = line.find(b'*', start)
+            if end < 0 or end + 3 > len(line):
+                continue
+
+            body = line[start + 1:end]
+            try:
+                valid = int(line[end + 1:end + 3], 16) == checksum(body)
+            except ValueError:
+                valid = False
+            if not valid:
+                self.bad_checksum += 1
+                continue
+            self.sentences += 1
+
+            if not isinstance(body, str):
+                body = body.decode('ascii', 'replace')
+            # proprietary sentences ($P...) have no talker id
+            sentence_type = body[2:5]
+            decoder = decoders.get(sentence_type)
+            if decoder is None or body[0] == 'P':
+                continue
+
+            fields = body.split(',')
+            try:
+                if len(fields) < decoder[1]:
+                    raise ValueError("%s has too few fields" % sentence_type)
+                values = decoder[0](fields)
+            except ValueError:
+                values = None
+                if pynmea2 is not None:
+                    try:
+                        values = _from_pynmea2(sentence_type, line[start:end + 3].decode('ascii', 'replace'))
+                    except (pynmea2.ParseError, ValueError, TypeError, AttributeError):
+                        pass
+                if values is None:
+                    self.errors += 1
+                    continue
+            results.append((sentence_type, values))
+        return results
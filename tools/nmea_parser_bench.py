@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+# Sentences per second through nmea_parser, and through pynmea2 fed a
+# character at a time the way nmea-receiver.py used to
+# The log is repeated to make a long run, and fed in --chunk sized pieces
+# like datagrams off the network.
+
+import argparse
+import os
+import time
+
+import nmea_parser
+
+try:
+    import pynmea2
+except ImportError:
+    pynmea2 = None
+
+parser = argparse.ArgumentParser(description="NMEA parser benchmark")
+parser.add_argument('log', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raw-nmea-log'), help="recorded NMEA to parse")
+parser.add_argument('--repeat', action="store", type=int, default=50, help="times to go through the log")
+parser.add_argument('--chunk', action="store", type=int, default=1024, help="bytes handed to the parser at a time")
+args = parser.parse_args()
+
+with open(args.log, 'rb') as f:
+    log = f.read()
+# the log may not end in a newline
+if not log.endswith(b'\n'):
+    log += b'\r\n'
+chunks = [log[i:i + args.chunk] for i in range(0, len(log), args.chunk)]
+
+
+def bulk():
+    nmea = nmea_parser.NMEAParser()
+    decoded = 0
+    for i in range(args.repeat):
+        for chunk in chunks:
+            decoded += len(nmea.parse(chunk))
+    return nmea.sentences + nmea.bad_checksum, decoded
+
+
+def stream():
+    # what nmea-receiver.py did before nmea_parser
+    reader = pynmea2.NMEAStreamReader()
+    sentences = 0
+    decoded = 0
+    for i in range(args.repeat):
+        for chunk in chunks:
+            for character in chunk.decode('ascii', 'replace'):
+                for message in reader.next(character):
+                    sentences += 1
+                    if message.sentence_type in nmea_parser.decoders:
+                        decoded += 1
+    return sentences, decoded
+
+
+def measure(name, function):
+    start = time.time()
+    sentences, decoded = function()
+    elapsed = time.time() - start
+    print("%-8s %8d sentences (%d decoded) in %6.3f s: %9.0f sentences/s" % (
+        name, sentences, decoded, elapsed, sentences / elapsed))
+
+
+print("%s, %d bytes x %d, %d byte chunks" % (args.log, len(log), args.repeat, args.chunk))
+measure('bulk', bulk)
+if pynmea2 is not None:
+    measure('pynmea2', stream)
+else:
+    print("pynmea2 isn't installed, no comparison")
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+# Shared memory broadcast ring for local consumers of comm_router
+# One writer (the router) appends packets, any number of readers follow
+# along at their own pace. Readers that fall more than a ring behind skip
+# ahead to the oldest packet still in the ring.
+#
+# Layout: a 64 byte header followed by the ring itself
+#   header: magic, version, capacity, write position
+#   record: length (u32), padding (u32), position (u64), data, aligned to 8
+# Positions are absolute byte counts, a record is at position % capacity.
+# A record that would not fit before the end of the ring is preceded by a
+# wrap marker and written at the start instead.
+
+import mmap
+import os
+import struct
+
+MAGIC = b'CRNG'
+VERSION = 1
+
+HEADER = struct.Struct('<4sIQQ')
+HEADER_SIZE = 64
+WRITE_POSITION_OFFSET = 16
+POSITION = struct.Struct('<Q')
+
+RECORD = struct.Struct('<IIQ')
+WRAP = 0xFFFFFFFF
+
+default_capacity = 1 << 20
+
+# a record this close to being overwritten may be half way through it
+# (the writer publishes a record only once it is complete)
+SAFETY_MARGIN = RECORD.size + 65536
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class Writer(object):
+
+    def __init__(self, path, capacity=default_capacity):
+        self.path = path
+        self.capacity = _align(capacity)
+        if self.capacity < 2 * SAFETY_MARGIN:
+            raise ValueError("ring capacity must be at least %d bytes" % (2 * SAFETY_MARGIN))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + self.capacity)
+            self.map = mmap.mmap(fd, HEADER_SIZE + self.capacity)
+        finally:
+            os.close(fd)
+        self.position = 0
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.capacity, 0)
+
+
+    def write(self, data):
+        size = RECORD.size + _align(len(data))
+        if size > SAFETY_MARGIN:
+            raise ValueError("%d byte packet doesn't fit in the ring" % len(data))
+
+        offset = self.position % self.capacity
+        if offset + size > self.capacity:
+            if offset + RECORD.size <= self.capacity:
+                RECORD.pack_into(self.map, HEADER_SIZE + offset, WRAP, 0, self.position)
+            self.position += self.capacity - offset
+            offset = 0
+
+        start = HEADER_SIZE + offset
+        RECORD.pack_into(self.map, start, len(data), 0, self.position)
+        self.map[start + RECORD.size:start + RECORD.size + len(data)] = data
+        self.position += size
+        # publish last, readers won't look past this
+        POSITION.pack_into(self.map, WRITE_POSITION_OFFSET, self.position)
+
+
+    def close(self):
+        self.map.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class Reader(object):
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, self.capacity, position = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a comm_router ring" % path)
+        # start with whatever is written next
+        self.position = position
+        self.lost = 0
+
+
+    def write_position(self):
+        return POSITION.unpack_from(self.map, WRITE_POSITION_OFFSET)[0]
+
+
+    def read(self):
+        """
+        Returns the list of packets written since the last call
+        """
+        packets = []
+        end = self.write_position()
+        while self.position < end:
+            if end - self.position > self.capacity - SAFETY_MARGIN:
+                # lapped by the writer
+                self.lost += 1
+                self.position = end
+                break
+
+            offset = self.position % self.capacity
+            if offset + RECORD.size > self.capacity:
+                self.position += self.capacity - offset
+                continue
+
+            start = HEADER_SIZE + offset
+            length, _, position = RECORD.unpack_from(self.map, start)
+            if position != self.position:
+                self.lost += 1
+                self.position = end
+                break
+            if length == WRAP:
+                self.position += self.capacity - offset
+                continue
+
+            data = self.map[start + RECORD.size:start + RECORD.size + length]
+            # the writer may have overwritten the record while we copied it
+            if self.write_position() - self.position > self.capacity - SAFETY_MARGIN:
+                self.lost += 1
+                self.position = self.write_position()
+                break
+
+            packets.append(data)
+            self.position += RECORD.size + _align(length)
+        return packets
+
+
+    def close(self):
+        self.map.close()
@@ -10,6 +10,8 @@ from datetime import datetime
 from os import system
 import operator
 
+import gps_input
+
 # Nmea messages templates
 # https://www.trimble.com/oem_receiverhelp/v4.44/en/NMEA-0183messages_GGA.html
 gpgga = ("$GPGGA,"                                    # Message ID
@@ -98,6 +100,7 @@ master = mavutil.mavlink_connection('udpbcast:192.168.2.255:14400', source_syste
 parser = argparse.ArgumentParser(description="Driver for the Water Linked Underwater GPS system.")
 parser.add_argument('--ip', action="store", type=str, default="demo.waterlinked.com", help="remote ip to query on.")
 parser.add_argument('--port', action="store", type=str, default="80", help="remote port to query on.")
+gps_input.add_arguments(parser)
 args = parser.parse_args()
 
 # New approach, UDP port 14401 for nmea data
@@ -113,13 +116,18 @@ while not connected:
 
 print("Found Water Linked underwater GPS!")
 
-system('screen -S mavproxy -p 0 -X stuff "param set GPS_TYPE 14^M"')
-
 sockit = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 sockit.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 sockit.setblocking(0)
 sockit.bind(('0.0.0.0', 25102))
 
+if args.output == 'mavlink':
+    gps_output = gps_input.MAVLinkOutput(args.mavlink, args.source_system)
+    gps_output.set_gps_type()
+else:
+    gps_output = gps_input.JSONOutput(sockit, ('0.0.0.0', 25100))
+    system('screen -S mavproxy -p 0 -X stuff "param set GPS_TYPE 14^M"')
+
 gpsUrl = "http://" + args.ip + ":" + args.port
 
 def processMasterPosition(response, *args, **kwargs):
@@ -184,10 +192,9 @@ def processLocatorPosition(response, *args, **kwargs):
     result['vdop'] = 1.0
     result['satellites_visible'] = 10
     result['ignore_flags'] = 8 | 16 | 32
-    result = json.dumps(result);
     print('sending      ', result)
 
-    sockit.sendto(result, ('0.0.0.0', 25100))
+    gps_output.send(result)
 
 def notifyPutResponse(response, *args, **kwargs):
     print('PUT response:', response.text)